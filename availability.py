@@ -0,0 +1,116 @@
+# Availability matrix and itinerary window search
+# --------------------------------------------------------------------------------------------------------------
+# Scan results are stacked into a lodges x days matrix of 0/1 cells. An itinerary is a list of stops, each
+# stop being the day offset of a night and the matrix rows of the lodges that can host it, so alternate
+# lodges and rest days (two stops on the same lodge) are plain itineraries too. Every start day of the
+# range is then checked at once with NumPy instead of one list comparison per start day. WindowTracker
+# does the same search while a scan runs, reporting a window as soon as its last needed cell comes in.
+# --------------------------------------------------------------------------------------------------------------
+
+from datetime import date
+import numpy as np
+
+
+def availability_matrix(day_lists, n_days):
+    """Stack one 0/1 list per lodge into a lodges x days int8 matrix, unknown (None) cells count as 0."""
+    day_lists = list(day_lists)
+    matrix = np.zeros((len(day_lists), n_days), dtype=np.int8)
+    for row, days in enumerate(day_lists):
+        for column, value in enumerate(days[:n_days]):
+            if value:
+                matrix[row, column] = 1
+    return matrix
+
+
+def default_itinerary(n_lodges):
+    """One night on each lodge in the given order, the plan np_scraper has always searched for."""
+    return [(night, (night,)) for night in range(n_lodges)]
+
+
+def itinerary_length(itinerary):
+    """Number of nights covered by an itinerary."""
+    return max(offset for offset, lodges in itinerary) + 1 if itinerary else 0
+
+
+def window_starts(matrix, itinerary, n_starts):
+    """Return the indexes of the start days among the first n_starts whose every stop has a free lodge."""
+    # Fewer dates than lodges leaves no start day at all
+    n_starts = max(n_starts, 0)
+    span = itinerary_length(itinerary)
+    # Pad on the right, so that stops past the end of the range count as unavailable
+    padded = np.zeros((matrix.shape[0], max(matrix.shape[1], n_starts + span)), dtype=np.int8)
+    padded[:, :matrix.shape[1]] = matrix
+    valid = np.ones(n_starts, dtype=bool)
+    for offset, lodges in itinerary:
+        valid &= padded[list(lodges), offset:offset + n_starts].any(axis=0)
+    return np.flatnonzero(valid)
+
+
+def roc_date_ordinals(date_range):
+    """Turn ROC dates such as 108-03-05 into day ordinals, without going through strptime."""
+    ordinals = []
+    for day in date_range:
+        year, month, mday = day.split('-')
+        ordinals.append(date(int(year) + 1911, int(month), int(mday)).toordinal())
+    return np.array(ordinals, dtype=np.int64)
+
+
+def consecutive_starts(ordinals, starts, n_nights):
+    """Keep the starts whose departure day lies at most n_nights calendar days later, for ranges with days left out."""
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = starts + n_nights
+    in_range = ends < len(ordinals)
+    keep = np.ones(len(starts), dtype=bool)
+    keep[in_range] = ordinals[ends[in_range]] - ordinals[starts[in_range]] <= n_nights
+    return starts[keep]
+
+
+class WindowTracker:
+    """
+    Itinerary window search fed one cell at a time, for scans that report windows while still running.
+    """
+    def __init__(self, n_lodges, n_days, itinerary, n_starts, ordinals=None, n_nights=None):
+        self.itinerary = itinerary
+        self.n_starts = max(n_starts, 0)
+        # 0/1 cells known so far, a cell not answered yet counts as 0
+        self.matrix = np.zeros((n_lodges, n_days), dtype=np.int8)
+        # Start days whose window is free, in the order they were found
+        self.found = []
+        self.reported = np.zeros(self.n_starts, dtype=bool)
+        # Stops of the itinerary each lodge takes part in, to find the windows one cell can complete
+        self.offsets = {}
+        for offset, lodges in itinerary:
+            for lodge in lodges:
+                self.offsets.setdefault(lodge, []).append(offset)
+        # Calendar days of the range and nights per window, when windows must not span days left out
+        self.ordinals = ordinals
+        self.n_nights = n_nights
+
+    def add(self, lodge, day, value):
+        """Record one cell, return the start days whose window it made free."""
+        self.matrix[lodge, day] = 1 if value else 0
+        if not value:
+            return []
+        new = []
+        for offset in self.offsets.get(lodge, ()):
+            start = day - offset
+            if 0 <= start < self.n_starts and not self.reported[start] and self.is_free(start):
+                self.reported[start] = True
+                new.append(start)
+        if self.ordinals is not None and new:
+            new = consecutive_starts(self.ordinals, new, self.n_nights).tolist()
+        self.found.extend(new)
+        return new
+
+    def is_free(self, start):
+        """True when every stop of the window of a start day has a lodge known to be free."""
+        n_days = self.matrix.shape[1]
+        for offset, lodges in self.itinerary:
+            day = start + offset
+            if day >= n_days or not self.matrix[list(lodges), day].any():
+                return False
+        return True
+
+    def starts(self):
+        """Return the free start days found so far, in date order."""
+        return sorted(self.found)
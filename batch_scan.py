@@ -0,0 +1,279 @@
+# Many team queries in one scan, each bed page fetched once
+# --------------------------------------------------------------------------------------------------------------
+# Reads query specs as JSON lines (or one JSON list) from a file or stdin, one query per line:
+#   {"name": "A隊", "park": "玉山", "lodge": ["排雲山莊"], "start": "2019-03-05", "end": "2019-03-20", "number": 5}
+#   {"name": "B隊", "park": "玉山", "lodge": ["排雲山莊", "圓峰山屋"], "start": "2019-03-10", "number": 3, "retain": "yes"}
+# The keys are the long options of np_scraper.py. Every query is planned into its (park, node_id, date) cells,
+# the union of those cells is fetched and parsed once, and then each query's team number and retain rules
+# are evaluated against the shared parsed pages. Queries that overlap in lodges and dates cost no extra request.
+#
+# Usage: python batch_scan.py queries.jsonl [--engine async] [--base-url http://127.0.0.1:8800]
+#        cat queries.jsonl | python batch_scan.py -
+# --------------------------------------------------------------------------------------------------------------
+
+import argparse
+import json
+import multiprocessing
+import sys
+from multiprocessing import Pool
+from time import perf_counter
+from urllib.parse import urlparse
+
+import http_session
+import np_scraper
+import rate_limiter
+import response_cache
+import scan_metrics
+
+
+def load_specs(stream):
+    """Return the query spec dicts of a JSON lines or JSON list text stream, each one named after its position if unnamed."""
+    text = stream.read()
+    if text.lstrip().startswith('['):
+        specs = json.loads(text)
+    else:
+        specs = [json.loads(line) for line in text.splitlines() if line.strip() and not line.lstrip().startswith('#')]
+    for n, spec in enumerate(specs):
+        spec.setdefault('name', "查詢{}".format(n + 1))
+        if isinstance(spec.get('lodge'), str):
+            spec['lodge'] = [spec['lodge']]
+    return specs
+
+
+class BatchQuery:
+    """
+    One query of a batch: its resolved park, lodges and dates and the fetch cell of each (lodge, date).
+    """
+    def __init__(self, spec, position=0):
+        self.spec = spec
+        self.name = spec.get('name') or "查詢{}".format(position + 1)
+        self.number = spec.get('number')
+        self.retain = spec.get('retain')
+        self.park = None
+        self.lodges = []
+        self.date_range = []
+        # Index into the batch's unique fetch list of each (lodge, date) cell, lodge by lodge
+        self.cell_indexes = []
+        # (name asked for, catalog name) of the lodge names the catalog corrected
+        self.corrections = []
+        self.error = None
+        self.result = None
+
+
+def resolve_park(park_name, base_url, catalog, parks, verbose):
+    """Return (park name, check bed page, orgid, {lodge name: node_id}, catalog) of a park, each looked up once per batch."""
+    national_park, get_lodge_link, check_bed_link = np_scraper.park_links(park_name)
+    if national_park not in parks:
+        entry = catalog.park(national_park) if catalog is not None else None
+        if entry is not None and entry['orgid']:
+            parks[national_park] = (national_park, check_bed_link, entry['orgid'], entry['lodges'], catalog)
+        else:
+            hp = np_scraper.TaiwanNationalParkWebParser(national_park, verbose=verbose)
+            lodge_camp_list, orgid = np_scraper.fetch_park_ids(hp, base_url, get_lodge_link)
+            parks[national_park] = (national_park, check_bed_link, orgid, lodge_camp_list, None)
+    return parks[national_park]
+
+
+def plan(specs, base_url, catalog=None, verbose=False):
+    """
+    Resolve every query spec and return (queries, fetch tasks). Each (url, park, fetch index) task is one
+    unique (park, node_id, date) bed page; a query that cannot be resolved keeps its error message instead.
+    """
+    parks = {}
+    # Live lodge list of each park with a lodge the catalog has not seen, downloaded at most once per batch
+    live_lists = {}
+    tasks = []
+    task_of_url = {}
+    queries = []
+    for position, spec in enumerate(specs):
+        query = BatchQuery(spec, position)
+        queries.append(query)
+        try:
+            national_park, check_bed_link, orgid, lodge_camp_list, park_catalog = resolve_park(spec['park'], base_url, catalog, parks, verbose)
+            lodges = []
+            for lodge in spec['lodge']:
+                match = park_catalog.lookup(national_park, lodge) if park_catalog is not None else ((lodge, lodge_camp_list[lodge]) if lodge in lodge_camp_list else None)
+                if match is None and park_catalog is not None:
+                    # The catalog can be up to max_age old, the site's own list decides before the name is rejected
+                    if national_park not in live_lists:
+                        hp = np_scraper.TaiwanNationalParkWebParser(national_park, verbose=verbose)
+                        live_lists[national_park] = hp.get_lodge_list("{}/{}".format(base_url, np_scraper.park_links(national_park)[1])) or {}
+                    if lodge in live_lists[national_park]:
+                        match = (lodge, live_lists[national_park][lodge])
+                if match is None:
+                    raise ValueError("{} <--名稱錯誤。\n請輸入正確的山屋/營地名稱。{}國家公園路線的山屋/營地如下：\n{}".format(lodge, national_park, list(lodge_camp_list.keys())))
+                lodges.append(match)
+            start_date, end_date, date_range = np_scraper.resolve_date_range(spec['lodge'], spec.get('start'), spec.get('end'),
+                                                                             query.number, query.retain, verbose=verbose)
+        except (ValueError, KeyError, ConnectionError) as ex:
+            query.error = str(ex)
+            continue
+        query.park = national_park
+        query.lodges = [name for name, node_id in lodges]
+        query.corrections = [(lodge, name) for lodge, (name, node_id) in zip(spec['lodge'], lodges) if lodge != name]
+        query.date_range = date_range
+        for name, node_id in lodges:
+            for n in date_range:
+                url = "{}/{}?orgid={}&node_id={}&sdate={}".format(base_url, check_bed_link, orgid, node_id, n)
+                if url not in task_of_url:
+                    task_of_url[url] = len(tasks)
+                    tasks.append((url, national_park, len(tasks)))
+                query.cell_indexes.append(task_of_url[url])
+    return queries, tasks
+
+
+def evaluate(query, cells, records, attempts, errors):
+    """Build the ScanResult of a query from the shared cells, with its own team number and retain rules."""
+    hp = np_scraper.TaiwanNationalParkWebParser(query.park, query.number, query.retain, verbose=False)
+    query_cells = []
+    for n, index in enumerate(query.cell_indexes):
+        cell = cells[index]
+        if cell is not None:
+            cell = cell._replace(lodge_id=n // len(query.date_range))
+            # A date that is not open keeps the 0 of parse_page, whatever the team
+            if cell.summarize is not None:
+                summarize = cell.summarize
+                if query.park == "玉山":
+                    # The shared page was parsed without a team, its 中籤率 depends on the team number
+                    summarize = dict(summarize, percentage=hp.draw_percentage(summarize['pool_total'], summarize['queue'],
+                                                                              summarize['examine'], summarize['approved']))
+                cell = cell._replace(summarize=summarize, available=hp.cell_available(query.park, summarize, cell.table))
+        query_cells.append(cell)
+    result = np_scraper.ScanResult(query.park, query.lodges, query.date_range, query_cells,
+                                   records=[records[index] for index in query.cell_indexes])
+    result.corrections = query.corrections
+    result.failures = [(query.lodges[n // len(query.date_range)], query.date_range[n % len(query.date_range)], attempts[index], errors[index])
+                       for n, index in enumerate(query.cell_indexes) if cells[index] is None]
+    if query.number:
+        result.available_date = hp.check_available_apply_date(result.lodge_available_list, query.lodges, query.date_range)
+    return result
+
+
+def run(specs, engine='pool', host_limit=100, parse_workers=0, base_url=None, catalog=None, cell_retries=1, pool=None, verbose=False):
+    """Plan, fetch and evaluate a batch of query specs, return (queries, scan_metrics summary of the shared fetch)."""
+    base_url = (base_url or np_scraper.NPM_BASE_URL).rstrip('/')
+    queries, tasks = plan(specs, base_url, catalog, verbose)
+    # One parser without a team number reads every page, the team rules are applied per query afterwards
+    hp = np_scraper.TaiwanNationalParkWebParser(page_parser='lxml', verbose=False)
+    cells = [None] * len(tasks)
+    records = [None] * len(tasks)
+    errors = [None] * len(tasks)
+    attempts = [0] * len(tasks)
+
+    def store(index, cell, record):
+        attempts[index] += 1
+        cells[index], records[index] = cell, record
+        if cell is None:
+            errors[index] = record['error'] or ("HTTP {}".format(record['status']) if record['status'] else "無回應")
+
+    # Create the limiter of the site before the Pool forks, so every worker shares its window and backoff
+    limiter = rate_limiter.limiter_for(urlparse(base_url).netloc)
+    own_pool = engine != "async" and pool is None and bool(tasks)
+    if own_pool:
+        pool = Pool(processes=multiprocessing.cpu_count(), initializer=np_scraper.init_worker, initargs=np_scraper.worker_initargs())
+    try:
+        started = perf_counter()
+        workers = 1
+        for _ in range(cell_retries + 1):
+            pending = [index for index, cell in enumerate(cells) if cell is None]
+            if not pending:
+                break
+            workers = np_scraper.fetch_tasks(hp, [tasks[index] for index in pending], engine, host_limit, parse_workers, pool,
+                                             lambda position, cell, record: store(pending[position], cell, record))
+        wall_s = perf_counter() - started
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+    metrics = scan_metrics.summarize(records, wall_s, workers)
+    metrics['cells_requested'] = sum(len(query.cell_indexes) for query in queries)
+    if limiter is not None:
+        metrics['limiter'] = limiter.stats()
+    # A query that fails to evaluate keeps its error, the others still get their results
+    for query in queries:
+        if query.error is None:
+            try:
+                query.result = evaluate(query, cells, records, attempts, errors)
+            except Exception as ex:
+                query.error = str(ex)
+    return queries, metrics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run many team queries with one fetch of every bed page")
+    parser.add_argument("queries", help="JSON lines file of query specs, - for stdin")
+    parser.add_argument("--engine", choices=["pool", "async"], default="pool", help="Fetch engine, see np_scraper.py. Default: pool")
+    parser.add_argument("--host-limit", type=int, default=100, help="Max requests in flight per host for --engine async. Default: 100")
+    parser.add_argument("--parse-workers", type=int, default=0, help="Worker processes for page parsing with --engine async, 0 parses in the main process. Default: 0")
+    parser.add_argument("--rps", type=float, default=rate_limiter.DEFAULT_RPS, help="Requests per second ceiling for the web site, 0 for none. Default: {}".format(rate_limiter.DEFAULT_RPS))
+    parser.add_argument("--max-retries", type=int, default=rate_limiter.DEFAULT_MAX_RETRIES, help="Retries of a request that timed out or got 429/5xx, after a jittered backoff. Default: {}".format(rate_limiter.DEFAULT_MAX_RETRIES))
+    parser.add_argument("--no-adaptive", action="store_true", help="Turn the adaptive rate limiter off: no concurrency window, rps ceiling, backoff or retry")
+    parser.add_argument("--cell-retries", type=int, default=1, help="More passes over the pages that failed after the first pass. Default: 1")
+    parser.add_argument("--base-url", default=np_scraper.NPM_BASE_URL, help="Root of the permit web site. Default: {}".format(np_scraper.NPM_BASE_URL))
+    parser.add_argument("--catalog", help="Local catalog of the parks and lodges, see lodge_catalog.py. Default: ~/.cache/np-scraper/catalog.json")
+    parser.add_argument("--no-catalog", action="store_true", help="Check the park and lodge names against the web site instead of the local catalog")
+    parser.add_argument("--no-cache", action="store_true", help="Always download pages from the web site and do not store them")
+    parser.add_argument("--bed-ttl", type=float, default=response_cache.DEFAULT_TTLS['bed'], help="Seconds to cache bed pages whose lottery is not drawn yet. Their queue and remaining bed counts are live, so they go stale. Default: 0, never cached")
+    parser.add_argument("--json", action="store_true", help="Print one JSON line per query")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.queries == '-':
+            specs = load_specs(sys.stdin)
+        else:
+            with open(args.queries, encoding='utf-8') as f:
+                specs = load_specs(f)
+    except (OSError, ValueError) as ex:
+        print(str(ex))
+        return 1
+
+    pool_size = max(http_session.DEFAULT_POOL_SIZE, args.host_limit) if args.engine == "async" else http_session.DEFAULT_POOL_SIZE
+    http_session.configure(pool_size=pool_size)
+    response_cache.configure(enabled=not args.no_cache, ttls={'bed': args.bed_ttl})
+    rate_limiter.configure(enabled=not args.no_adaptive, rps=args.rps, max_retries=args.max_retries,
+                           max_window=args.host_limit if args.engine == "async" else multiprocessing.cpu_count())
+
+    catalog = None
+    refresh_due = False
+    if not args.no_catalog:
+        import lodge_catalog
+        catalog = lodge_catalog.LodgeCatalog(args.base_url, args.catalog or lodge_catalog.DEFAULT_CATALOG_PATH)
+        try:
+            refresh_due = catalog.ensure()
+        except Exception as ex:
+            print(str(ex))
+            catalog = None
+
+    queries, metrics = run(specs, engine=args.engine, host_limit=args.host_limit, parse_workers=args.parse_workers,
+                           base_url=args.base_url, catalog=catalog, cell_retries=args.cell_retries)
+    # A stale catalog is fetched again while the reports are printed, after the batch so no worker forks meanwhile
+    refresher = catalog.refresh_in_background() if refresh_due else None
+    for query in queries:
+        if args.json:
+            report = {'name': query.name, 'error': query.error}
+            if query.result is not None:
+                report.update(park=query.park, lodges=query.lodges, corrections=query.corrections, number=query.number,
+                              available_date=query.result.available_date, failures=len(query.result.failures))
+            print(json.dumps(report, ensure_ascii=False))
+            continue
+        for lodge, name in query.corrections:
+            print("{}：{} --> {}，以目錄中的名稱查詢".format(query.name, lodge, name))
+        if query.error is not None:
+            print("{}：{}".format(query.name, query.error))
+        elif query.number:
+            dates = query.result.available_date
+            print("{}：{} {}，隊伍{}人，共{}個時段可申請入園 {}".format(query.name, query.park, "、".join(query.lodges), query.number,
+                                                            len(dates), " ".join(dates)))
+        else:
+            print("{}：{} {}，共查詢{}個日期".format(query.name, query.park, "、".join(query.lodges), len(query.date_range)))
+    if not args.json:
+        print("共{}個查詢，{}個山屋日期，實際下載{}個頁面".format(len(queries), metrics['cells_requested'], metrics['cells']))
+        scan_metrics.print_summary(metrics)
+    if refresher is not None:
+        refresher.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
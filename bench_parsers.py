@@ -0,0 +1,148 @@
+# Offline parse-throughput benchmark
+# --------------------------------------------------------------------------------------------------------------
+# Runs the page parsers against the HTML fixtures in fixtures/ and reports pages per second and per-page
+# latency percentiles, so parser changes can be judged on numbers without touching the live sites.
+#
+# The fixtures are synthesized from the structure the parsers read on the live pages (ContentPlaceHolder1_*
+# span ids, the DATAM table, the bed_menu links, the lodge <option> list, the jmlnt calendar_table and
+# list_table), padded with a __VIEWSTATE blob and navigation markup to a realistic page size.
+#
+# Usage: python bench_parsers.py [-n 200] [-k parse_url] [--json]
+# --------------------------------------------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+from time import perf_counter
+
+import np_scraper
+import login
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Page name of each npm.cpami.gov.tw url, used to answer fetch_page from the fixtures
+FIXTURE_PAGES = {
+    'bed_menu': 'bed_menu.html',
+    'bed_1.aspx': 'bed_1.html',
+    'bed_4.aspx': 'bed_4.html',
+    'bed_6.aspx': 'bed_6.html',
+    'bed_1main': 'bed_1main.html',
+    'bed_4main': 'bed_4main.html',
+    'bed_6main': 'bed_6main.html',
+}
+
+
+def load_fixture(name):
+    """Return the text of a fixture file."""
+    with open(os.path.join(FIXTURE_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+class FixtureParser(np_scraper.TaiwanNationalParkWebParser):
+    """Park page parser that answers every fetch from the fixtures instead of the web site."""
+    def __init__(self, *args, pages=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pages = pages or {}
+
+    def fetch_page(self, url):
+        for key, name in FIXTURE_PAGES.items():
+            if key in url:
+                return self.pages.get(url) or load_fixture(name)
+
+
+def percentile(sorted_values, q):
+    """q-th percentile of an already sorted list, nearest-rank method."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(q / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_case(func, iterations):
+    """Call func iterations times and return its throughput and latency percentiles."""
+    func()  # warm up caches and lazy imports outside of the measure
+    latencies = []
+    started = perf_counter()
+    for _ in range(iterations):
+        t = perf_counter()
+        func()
+        latencies.append(perf_counter() - t)
+    elapsed = perf_counter() - started
+    latencies.sort()
+    return {'pages': iterations, 'pages_per_s': iterations / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000, 'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000}
+
+
+def build_cases():
+    """Return [(name, callable)] of every parser on every fixture it applies to."""
+    from bs4 import BeautifulSoup
+    cases = []
+    for backend in ('lxml', 'bs4'):
+        for park, url, name in (('玉山', 'https://npm.cpami.gov.tw/bed_6main.aspx', 'bed_6main.html'),
+                                ('玉山', 'https://npm.cpami.gov.tw/bed_6main.aspx?empty', 'bed_6main_no_table.html'),
+                                ('雪霸', 'https://npm.cpami.gov.tw/bed_1main.aspx', 'bed_1main.html'),
+                                ('太魯閣', 'https://npm.cpami.gov.tw/bed_4main.aspx', 'bed_4main.html')):
+            hp = FixtureParser(park, team_number='5', page_parser=backend, verbose=False, pages={url: load_fixture(name)})
+            cases.append(('parse_url[{}] {}'.format(backend, name), lambda hp=hp, url=url, park=park: hp.parse_url(url, park, 0)))
+
+    hp = FixtureParser('玉山', verbose=False)
+    datam = hp.extract_page(load_fixture('bed_6main.html'))[1]
+    cases.append(('parse_html_table[rows] bed_6main.html', lambda: hp.parse_html_table(datam, None, None, as_frame=False)))
+    cases.append(('parse_html_table[frame] bed_6main.html', lambda: hp.parse_html_table(datam, None, None, as_frame=True)))
+    cases.append(('get_lodge_list bed_6.html', lambda: hp.get_lodge_list('https://npm.cpami.gov.tw/bed_6.aspx')))
+    cases.append(('parse_orgid bed_menu.html', lambda: hp.parse_orgid('https://npm.cpami.gov.tw/bed_menu.aspx')))
+
+    orders = BeautifulSoup(load_fixture('jmlnt_orders.html'), 'lxml').find("table", class_="list_table")
+    session = login.MyLoginSession.__new__(login.MyLoginSession)
+    cases.append(('parse_order_table jmlnt_orders.html', lambda: session.parse_order_table(orders)))
+    import order_list
+    cases.append(('parse_orders jmlnt_orders.html', lambda: list(order_list.parse_orders(orders))))
+    orders_html = load_fixture('jmlnt_orders.html')
+    watcher = order_list.OrderWatcher()
+    watcher.update(orders_html)
+    cases.append(('OrderWatcher.update unchanged jmlnt_orders.html', lambda: watcher.update(orders_html)))
+
+    # Charset of a bed page: detection over the whole body against http_session.decode
+    import requests
+    import http_session
+    def bed_response(content_type):
+        resp = requests.models.Response()
+        resp._content = load_fixture('bed_6main.html').encode('utf-8')
+        resp.headers['Content-Type'] = content_type
+        resp.url = 'https://npm.cpami.gov.tw/bed_6main.aspx'
+        return resp
+    declared, undeclared = bed_response('text/html; charset=utf-8'), bed_response('text/html')
+    cases.append(('apparent_encoding bed_6main.html', lambda: declared.apparent_encoding))
+    cases.append(('decode[header] bed_6main.html', lambda: http_session.decode(declared)))
+    cases.append(('decode[meta] bed_6main.html', lambda: http_session.decode(undeclared)))
+
+    checker = login.LodgeRoomChecker()
+    calendar = load_fixture('jmlnt_calendar.html')
+    cases.append(('parse_calendar jmlnt_calendar.html', lambda: checker.parse_calendar(calendar)))
+    from room_calendar import RoomCalendar
+    cases.append(('RoomCalendar.from_days jmlnt_calendar.html', lambda: RoomCalendar.from_days(2019, 6, checker.parse_calendar(calendar))))
+    return cases
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the page parsers against the offline HTML fixtures")
+    parser.add_argument('-n', '--iterations', type=int, default=200, help="Pages parsed per case. Default: 200")
+    parser.add_argument('-k', '--only', help="Only run the cases whose name contains this text")
+    parser.add_argument('--json', action='store_true', help="Print one JSON line per case instead of a table")
+    args = parser.parse_args(argv)
+
+    if not args.json:
+        print("{:<45} {:>10} {:>9} {:>9} {:>9}".format('case', 'pages/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, func in build_cases():
+        if args.only and args.only not in name:
+            continue
+        stats = run_case(func, args.iterations)
+        if args.json:
+            print(json.dumps(dict(case=name, **stats), ensure_ascii=False))
+        else:
+            print("{:<45} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f}".format(name, stats['pages_per_s'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms']))
+
+
+if __name__ == "__main__":
+    main()
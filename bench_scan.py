@@ -0,0 +1,94 @@
+# End-to-end scan benchmark against the local stand-in server
+# --------------------------------------------------------------------------------------------------------------
+# Starts standin_server.py on a free port, points np_scraper.scan() at it and reports the scan wall time and
+# the requests per second the server saw, for a lodges x days matrix under the chosen latency, error rate and
+# rps ceiling. The response cache is turned off, so every cell is a real HTTP round trip.
+#
+# Usage: python bench_scan.py [--lodges 5] [--days 120] [--engine pool|async] [--latency 80] [--rps 0] [--json]
+# --------------------------------------------------------------------------------------------------------------
+
+import argparse
+import json
+import multiprocessing
+from datetime import date, timedelta
+from time import perf_counter
+
+import http_session
+import np_scraper
+import rate_limiter
+import response_cache
+import scan_metrics
+import standin_server
+
+# Lodge names of fixtures/bed_N.html for each park
+PARK_LODGES = {
+    '玉山': ['排雲山莊', '圓峰山屋', '圓峰營地', '觀高營地', '中央金礦山屋', '大水窟山屋'],
+    '雪霸': ['三六九山莊', '七卡山莊', '雪山北峰營地', '翠池山屋', '新達山屋', '素密達山屋'],
+    '太魯閣': ['成功堡', '奇萊山屋', '天池山莊', '磐石營地'],
+}
+
+
+def run(park='玉山', lodges=5, days=120, engine='pool', host_limit=100, pool_size=http_session.DEFAULT_POOL_SIZE,
+        team_number=None, latency=0.0, jitter=0.0, error_rate=0.0, rps=0.0, metrics_path=None, client_rps=rate_limiter.DEFAULT_RPS):
+    """Run one scan against a fresh stand-in server and return its wall time, request counters and scan metrics."""
+    lodge_campsite = PARK_LODGES[park][:lodges]
+    start_date = date.today() + timedelta(days=7)
+    end_date = start_date + timedelta(days=days - 1)
+
+    server = standin_server.start(latency=latency, jitter=jitter, error_rate=error_rate, rps=rps, seed=2019)
+    http_session.configure(pool_size=max(pool_size, host_limit) if engine == 'async' else pool_size)
+    response_cache.configure(enabled=False)
+    rate_limiter.configure(rps=client_rps, max_window=host_limit if engine == 'async' else multiprocessing.cpu_count())
+    try:
+        started = perf_counter()
+        result = np_scraper.scan(park, lodge_campsite, str(start_date), str(end_date), team_number=team_number,
+                                 engine=engine, host_limit=host_limit, base_url=server.base_url)
+        wall = perf_counter() - started
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if metrics_path:
+        scan_metrics.write_metrics(metrics_path, result.records, result.metrics)
+    counters = dict(server.counters)
+    return {'park': park, 'lodges': len(lodge_campsite), 'days': len(result.date_range), 'engine': engine,
+            'cells': len(result.cells), 'answered': sum(1 for cell in result.cells if cell is not None and cell.summarize),
+            'wall_s': wall, 'requests': counters['requests'], 'requests_per_s': counters['requests'] / wall if wall else 0.0,
+            'errors': counters['errors'], 'throttled': counters['throttled'], 'available_dates': len(result.available_date),
+            'metrics': result.metrics}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark a full scan against the local stand-in server")
+    parser.add_argument('-p', '--park', choices=list(PARK_LODGES), default='玉山', help="National Park to scan. Default: 玉山")
+    parser.add_argument('--lodges', type=int, default=5, help="Number of lodges of the park to scan. Default: 5")
+    parser.add_argument('--days', type=int, default=120, help="Number of dates to scan. Default: 120")
+    parser.add_argument('--engine', choices=['pool', 'async'], default='pool', help="Fetch engine of the scan. Default: pool")
+    parser.add_argument('--host-limit', type=int, default=100, help="Max requests in flight for --engine async. Default: 100")
+    parser.add_argument('--pool-size', type=int, default=http_session.DEFAULT_POOL_SIZE, help="Keep-alive connections per worker. Default: {}".format(http_session.DEFAULT_POOL_SIZE))
+    parser.add_argument('-n', '--number', help="Team number, also times the window search")
+    parser.add_argument('--latency', type=float, default=80, help="Server latency in milliseconds. Default: 80")
+    parser.add_argument('--jitter', type=float, default=40, help="Server latency jitter in milliseconds. Default: 40")
+    parser.add_argument('--error-rate', type=float, default=0, help="Share of requests the server answers with 500. Default: 0")
+    parser.add_argument('--rps', type=float, default=0, help="Server requests per second ceiling, 0 for none. Default: 0")
+    parser.add_argument('--client-rps', type=float, default=rate_limiter.DEFAULT_RPS, help="Requests per second ceiling of the scan's rate limiter, 0 for none. Default: {}".format(rate_limiter.DEFAULT_RPS))
+    parser.add_argument('--metrics', help="Also write the per-request metrics of the scan, see scan_metrics.py")
+    parser.add_argument('--json', action='store_true', help="Print the report as one JSON line")
+    args = parser.parse_args(argv)
+
+    report = run(args.park, args.lodges, args.days, args.engine, args.host_limit, args.pool_size, args.number,
+                 args.latency / 1000, args.jitter / 1000, args.error_rate, args.rps, args.metrics, args.client_rps)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False))
+        return
+    print("{park} {lodges} lodges x {days} days, engine {engine}".format(**report))
+    print("  wall time      {:>9.2f} s".format(report['wall_s']))
+    print("  requests       {:>9} ({:.1f}/s)".format(report['requests'], report['requests_per_s']))
+    print("  cells answered {:>9} of {}".format(report['answered'], report['cells']))
+    print("  errors         {:>9}".format(report['errors']))
+    print("  throttled      {:>9}".format(report['throttled']))
+    scan_metrics.print_summary(report['metrics'])
+
+
+if __name__ == "__main__":
+    main()
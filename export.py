@@ -0,0 +1,158 @@
+# Export scan results to Excel, CSV, JSON lines or Parquet
+# --------------------------------------------------------------------------------------------------------------
+# A scan keeps every per-date summary and DATAM table in memory, and the whole set is written once at the end.
+# Excel goes through openpyxl write-only mode and CSV/JSON lines are streamed row by row, so the cost grows
+# with the number of rows instead of re-reading the workbook for every date.
+# --------------------------------------------------------------------------------------------------------------
+
+import csv
+import json
+import os
+
+FORMATS = ('xlsx', 'csv', 'jsonl', 'parquet')
+SUMMARY_SHEET = "入園申請摘要"
+TABLE_SHEET = "入園申請查詢表"
+
+
+def output_format(path, fmt=None):
+    """Return the export format, given explicitly or taken from the file extension."""
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt == 'xls':
+        fmt = 'xlsx'
+    if fmt not in FORMATS:
+        raise ValueError("不支援的匯出格式：{}，請使用 {}".format(fmt, " / ".join(FORMATS)))
+    return fmt
+
+
+def table_rows_of(table):
+    """Return (columns, row tuples) of a DATAM table kept as TableRows or as a pandas DataFrame."""
+    if hasattr(table, 'itertuples'):
+        return [str(c) for c in table.columns], [tuple(row) for row in table.itertuples(index=False)]
+    return [str(c) for c in table.columns], table.rows
+
+
+def scan_records(result):
+    """Flatten a ScanResult into summary records (one per date and lodge) and table records (one per DATAM row)."""
+    summaries = []
+    tables = []
+    for cell in result.cells:
+        if cell is None or cell.summarize is None:
+            continue
+        summary = dict(cell.summarize)
+        summary['available'] = cell.available
+        summaries.append(summary)
+        if cell.table is not None:
+            columns, rows = table_rows_of(cell.table)
+            for row in rows:
+                record = {'search_date': cell.summarize['search_date'], 'lodge': cell.summarize['lodge']}
+                record.update(zip(columns, row))
+                tables.append(record)
+    return summaries, tables
+
+
+def record_columns(records):
+    """Union of the record keys, in the order they first appear."""
+    columns = {}
+    for record in records:
+        for key in record:
+            columns.setdefault(key, None)
+    return list(columns)
+
+
+def plain(value):
+    """Turn a value into something every writer accepts."""
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if hasattr(value, 'item'):
+        # NumPy scalar
+        return value.item()
+    return str(value)
+
+
+def sibling_path(path, suffix):
+    """Path next to 'path' with suffix added to its file name, such as scan.csv -> scan_tables.csv."""
+    stem, ext = os.path.splitext(path)
+    return "{}_{}{}".format(stem, suffix, ext)
+
+
+def write_scan(path, result, fmt=None):
+    """Write every summary and DATAM table of a ScanResult once, return the list of files written."""
+    summaries, tables = scan_records(result)
+    return write_records(path, summaries, tables, fmt)
+
+
+def write_records(path, summaries, tables, fmt=None):
+    """Write summary and table records to path, CSV and Parquet put the tables in a sibling '_tables' file."""
+    fmt = output_format(path, fmt)
+    if fmt == 'xlsx':
+        write_xlsx(path, [(SUMMARY_SHEET, summaries), (TABLE_SHEET, tables)])
+        return [path]
+    if fmt == 'jsonl':
+        write_jsonl(path, summaries, tables)
+        return [path]
+
+    table_path = sibling_path(path, 'tables')
+    if fmt == 'csv':
+        write_csv(path, summaries)
+        write_csv(table_path, tables)
+    else:
+        write_parquet(path, summaries)
+        write_parquet(table_path, tables)
+    return [path, table_path]
+
+
+def write_xlsx(path, sheets):
+    """Write (sheet name, records) pairs with openpyxl in write-only mode, the workbook is saved once."""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    for sheet_name, records in sheets:
+        ws = wb.create_sheet(sheet_name)
+        columns = record_columns(records)
+        ws.append(columns)
+        for record in records:
+            ws.append([plain(record.get(column)) for column in columns])
+    wb.save(path)
+
+
+def write_frames(path, frames):
+    """Write {sheet name: DataFrame} to an Excel file in write-only mode."""
+    sheets = []
+    for sheet_name, df in frames.items():
+        columns, rows = table_rows_of(df)
+        sheets.append((sheet_name, [dict(zip(columns, row)) for row in rows]))
+    write_xlsx(path, sheets)
+
+
+def write_csv(path, records):
+    """Stream records to a CSV file, with a header taken from the union of their keys."""
+    columns = record_columns(records)
+    with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for record in records:
+            writer.writerow({key: plain(value) for key, value in record.items()})
+
+
+def write_jsonl(path, summaries, tables):
+    """Write one JSON line per summary, with the DATAM rows of the same date and lodge nested under 'table'."""
+    rows_by_cell = {}
+    for record in tables:
+        key = (record['search_date'], record['lodge'])
+        rows_by_cell.setdefault(key, []).append({k: plain(v) for k, v in record.items() if k not in ('search_date', 'lodge')})
+    with open(path, 'w', encoding='utf-8') as f:
+        for summary in summaries:
+            line = {key: plain(value) for key, value in summary.items()}
+            line['table'] = rows_by_cell.get((summary['search_date'], summary['lodge']), [])
+            f.write(json.dumps(line, ensure_ascii=False) + '\n')
+
+
+def write_parquet(path, records):
+    """Write records to a Parquet file, this needs pandas with pyarrow or fastparquet."""
+    import pandas as pd
+    df = pd.DataFrame.from_records([{key: plain(value) for key, value in record.items()} for record in records],
+                                   columns=record_columns(records))
+    # Parquet columns hold one type, 中籤率 mixes numbers and text such as N/A
+    for column in df.columns:
+        if df[column].dtype == object and df[column].map(type).nunique() > 1:
+            df[column] = df[column].map(lambda value: None if value is None else str(value))
+    df.to_parquet(path, index=False)
@@ -0,0 +1,211 @@
+# Pooled keep-alive HTTP sessions shared by the National Park scrapers
+# --------------------------------------------------------------------------------------------------------------
+# Every process (the main one and each Pool worker) owns one requests.Session, so repeated queries to
+# npm.cpami.gov.tw reuse their TCP/TLS connections instead of opening a new one per date.
+# Each GET also leaves its connect / time to first byte / download split in a thread-local record, which the
+# scan metrics read back with last_timing(). Requests go through the rate_limiter of their host, which
+# spaces them out, sizes the timeout and retries timeouts, 429 and 5xx after a jittered backoff.
+# decode() turns a response into text with the charset of its header or meta tag, or the one learned for its
+# host, and only runs charset detection over the body when that charset fails to decode it.
+# --------------------------------------------------------------------------------------------------------------
+
+import os
+import re
+import threading
+from time import perf_counter
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+import rate_limiter
+
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/53.0.2785.143 Safari/537.36'
+DEFAULT_HEADERS = {'user-agent': USER_AGENT, 'connection': 'keep-alive'}
+DEFAULT_TIMEOUT = 10
+DEFAULT_POOL_SIZE = 10
+
+_settings = {'pool_size': DEFAULT_POOL_SIZE, 'headers': dict(DEFAULT_HEADERS)}
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+_timing = threading.local()
+# Charset each host was last decoded with, for pages that do not declare one
+_encodings = {}
+
+charset_pattern = re.compile(r'charset\s*=\s*["\']?([-\w.:]+)', re.I)
+meta_charset_pattern = re.compile(rb'<meta[^>]+charset\s*=\s*["\']?([-\w.:]+)', re.I)
+# A meta charset must come within the first 1024 bytes of a page, leave some room for sloppy pages
+META_SCAN_BYTES = 2048
+
+
+class TimedHTTPConnection(HTTPConnection):
+    """HTTP connection that adds the time spent opening it (DNS lookup and TCP connect) to the thread-local timing."""
+    def connect(self):
+        started = perf_counter()
+        try:
+            super().connect()
+        finally:
+            _timing.connect_s = getattr(_timing, 'connect_s', 0.0) + perf_counter() - started
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """HTTPS connection that adds the time spent opening it (DNS lookup, TCP connect and TLS handshake) to the thread-local timing."""
+    def connect(self):
+        started = perf_counter()
+        try:
+            super().connect()
+        finally:
+            _timing.connect_s = getattr(_timing, 'connect_s', 0.0) + perf_counter() - started
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools open timed connections, a reused keep-alive connection costs no connect time."""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+
+def configure(pool_size=None, headers=None):
+    """Set the connection pool size and extra shared headers. Also used as Pool worker initializer."""
+    global _session
+    with _lock:
+        if pool_size:
+            _settings['pool_size'] = int(pool_size)
+        if headers:
+            _settings['headers'].update(headers)
+        # Build the session again with the new settings on next use
+        # A forked worker leaves the copy inherited from its parent alone
+        if _session is not None and _session_pid == os.getpid():
+            _session.close()
+        _session = None
+
+
+def settings():
+    """Return a copy of the current settings, in the keyword form configure() takes."""
+    return {'pool_size': _settings['pool_size'], 'headers': dict(_settings['headers'])}
+
+
+def get_session():
+    """Return the pooled session of this process, a forked worker gets its own one."""
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                session = requests.Session()
+                adapter = TimedHTTPAdapter(pool_connections=_settings['pool_size'], pool_maxsize=_settings['pool_size'])
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers.update(_settings['headers'])
+                _session, _session_pid = session, pid
+    return _session
+
+
+def get(url, **kwargs):
+    """
+    GET an url through the pooled session and the rate limiter of its host. Without a limiter the default
+    timeout is used unless one is given, and the request is not retried.
+    """
+    limiter = rate_limiter.limiter_for(urlparse(url).netloc)
+    if limiter is None:
+        kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+        return timed_get(url, **kwargs)
+
+    attempt = 0
+    # Time spent waiting for a slot of the limiter, over every attempt, so it is not taken for network time
+    limiter_wait_s = 0.0
+    while True:
+        waited = perf_counter()
+        limiter.acquire()
+        started = perf_counter()
+        limiter_wait_s += started - waited
+        try:
+            resp = timed_get(url, **dict(kwargs, timeout=kwargs.get('timeout') or limiter.timeout()))
+        except (requests.Timeout, requests.ConnectionError):
+            limiter.release('timeout', perf_counter() - started)
+            if attempt >= limiter.max_retries:
+                raise
+        except BaseException:
+            # Any other failure still gives the slot back, the window is shared by every worker
+            limiter.release('error', perf_counter() - started)
+            raise
+        else:
+            retry = resp.status_code in rate_limiter.RETRY_STATUSES
+            limiter.release('error' if retry else 'ok', perf_counter() - started)
+            if not retry or attempt >= limiter.max_retries:
+                _timing.last['retries'] = attempt
+                _timing.last['limiter_wait_s'] = limiter_wait_s
+                return resp
+        attempt += 1
+
+
+def timed_get(url, **kwargs):
+    """One GET through the pooled session, leaving its timing for last_timing()."""
+    _timing.connect_s = 0.0
+    _timing.last = None
+    started = perf_counter()
+    resp = get_session().get(url, **kwargs)
+    total = perf_counter() - started
+    # elapsed runs from sending the request to parsing the response headers, and includes opening a connection
+    elapsed = resp.elapsed.total_seconds()
+    _timing.last = {'status': resp.status_code, 'bytes': len(resp.content), 'connect_s': _timing.connect_s,
+                    'ttfb_s': max(0.0, elapsed - _timing.connect_s), 'download_s': max(0.0, total - elapsed),
+                    'retries': 0, 'limiter_wait_s': 0.0, 'decode_s': 0.0, 'charset': None}
+    return resp
+
+
+def declared_encoding(resp):
+    """Return (source, charset) of the charset a response declares in its Content-Type header or a meta tag, (None, None) if none."""
+    match = charset_pattern.search(resp.headers.get('content-type', ''))
+    if match:
+        return 'header', match.group(1)
+    match = meta_charset_pattern.search(resp.content[:META_SCAN_BYTES])
+    if match:
+        return 'meta', match.group(1).decode('ascii')
+    return None, None
+
+
+def decode(resp):
+    """
+    Return the text of a response. It is decoded with its declared charset, or else the one learned for its
+    host; the body goes through charset detection (apparent_encoding) only when neither decodes it.
+    """
+    started = perf_counter()
+    host = urlparse(resp.url).netloc
+    source, encoding = declared_encoding(resp)
+    if encoding is None and host in _encodings:
+        source, encoding = 'learned', _encodings[host]
+    text = None
+    if encoding is not None:
+        try:
+            text = resp.content.decode(encoding)
+        except (UnicodeDecodeError, LookupError):
+            text = None
+    if text is None:
+        source, encoding = 'detected', resp.apparent_encoding or 'utf-8'
+        text = resp.content.decode(encoding, errors='replace')
+    _encodings[host] = encoding
+    resp.encoding = encoding
+    timing = last_timing()
+    if timing is not None:
+        timing['decode_s'], timing['charset'] = perf_counter() - started, source
+    return text
+
+
+def clear_timing():
+    """Forget the timing of the last request of this thread."""
+    _timing.last = None
+
+
+def last_timing():
+    """Return the timing of the last get() of this thread, None if it made no request since clear_timing()."""
+    return getattr(_timing, 'last', None)
@@ -0,0 +1,173 @@
+# Local catalog of the parks, orgids and lodges of the permit web site
+# --------------------------------------------------------------------------------------------------------------
+# One JSON file holds, for every National Park, its orgid from bed_menu, its lodge list and check bed pages
+# and every lodge name -> node_id, so a scan validates its park and lodge names without any request. The
+# catalog is fetched again in the background once it is older than refresh_after, and a scan waits for a
+# fresh one only when it is older than max_age or missing. Lodge names are matched after Unicode, 台/臺 and
+# 庄/莊 normalization, then by closest spelling, so 排雲山庄 or 排雲 山莊 still find 排雲山莊. A close
+# spelling has to be close enough that one wrong character of a four character name does not match.
+#
+# Usage: python lodge_catalog.py [--refresh] [--base-url http://127.0.0.1:8800] [-p 玉山]
+# --------------------------------------------------------------------------------------------------------------
+
+import argparse
+import difflib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+
+import http_session
+import np_scraper
+
+DEFAULT_CATALOG_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'np-scraper', 'catalog.json')
+# Refreshed in the background after a day, a scan never uses a catalog older than 30 days
+DEFAULT_REFRESH_AFTER = 24 * 3600
+DEFAULT_MAX_AGE = 30 * 24 * 3600
+# Least similarity of a misspelled lodge name to the catalog name it is taken for. Above the 0.75 of four
+# character names one character apart, so 排雲山屋 is not silently taken for 排雲山莊
+MATCH_CUTOFF = 0.8
+
+
+def normalize(name):
+    """Lodge or park name folded for comparison: full-width forms, blanks, 臺, 庄 and 國家公園 do not matter."""
+    name = unicodedata.normalize('NFKC', name)
+    return ''.join(name.split()).replace('臺', '台').replace('庄', '莊').replace('國家公園', '')
+
+
+def fetch_catalog(base_url):
+    """Download bed_menu and the lodge list of every park, return the catalog entry of a site."""
+    parks = {}
+    resp = http_session.get("{}/bed_menu.aspx".format(base_url))
+    resp.raise_for_status()
+    orgids = np_scraper.parse_orgids(http_session.decode(resp))
+    for park, (lodge_page, bed_page) in np_scraper.PARK_PAGES.items():
+        resp = http_session.get("{}/{}".format(base_url, lodge_page))
+        resp.raise_for_status()
+        parks[park] = {'orgid': next((orgid for name, orgid in orgids if park in name), None), 'lodge_page': lodge_page,
+                       'bed_page': bed_page, 'lodges': np_scraper.parse_lodge_list(http_session.decode(resp))}
+    return {'fetched_at': time.time(), 'parks': parks}
+
+
+class LodgeCatalog:
+    """
+    Parks and lodges of one site, read from the catalog file and refreshed from the site when stale.
+    """
+    def __init__(self, base_url=None, path=DEFAULT_CATALOG_PATH, refresh_after=DEFAULT_REFRESH_AFTER, max_age=DEFAULT_MAX_AGE):
+        self.base_url = (base_url or np_scraper.NPM_BASE_URL).rstrip('/')
+        self.path = path
+        self.refresh_after = refresh_after
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.refresher = None
+        self.entry = self.read().get(self.base_url)
+
+    def read(self):
+        """Return the whole catalog file, {base url: entry}, empty if it is missing or unreadable."""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def age(self):
+        """Seconds since the catalog of this site was fetched, None if there is none."""
+        return time.time() - self.entry['fetched_at'] if self.entry else None
+
+    def refresh(self):
+        """Fetch the catalog of this site now and write it, keeping the entries of other sites."""
+        entry = fetch_catalog(self.base_url)
+        with self.lock:
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            catalog = self.read()
+            catalog[self.base_url] = entry
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix='.catalog-', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(catalog, f, ensure_ascii=False)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self.entry = entry
+        return entry
+
+    def refresh_in_background(self):
+        """Start refreshing on a daemon thread, once, and return the thread."""
+        def run():
+            try:
+                self.refresh()
+            except Exception as ex:
+                print(str(ex))
+
+        with self.lock:
+            if self.refresher is None or not self.refresher.is_alive():
+                self.refresher = threading.Thread(target=run, daemon=True)
+                self.refresher.start()
+            return self.refresher
+
+    def ensure(self):
+        """Fetch the catalog first when it is missing or older than max_age, return True when a background refresh is due."""
+        age = self.age()
+        if age is None or age > self.max_age:
+            self.refresh()
+            return False
+        return age > self.refresh_after
+
+    def park(self, national_park):
+        """Return the catalog entry of a park, such as 玉山 or 玉山國家公園, None if it is not in the catalog."""
+        if not self.entry:
+            return None
+        parks = {normalize(name): name for name in self.entry['parks']}
+        name = parks.get(normalize(national_park))
+        return dict(self.entry['parks'][name], name=name) if name else None
+
+    def lookup(self, national_park, lodge):
+        """Return (catalog lodge name, node_id) of a lodge of a park, tolerant to small spelling variations, None if nothing is close."""
+        park = self.park(national_park)
+        if park is None:
+            return None
+        lodges = park['lodges']
+        if lodge in lodges:
+            return lodge, lodges[lodge]
+        names = {normalize(name): name for name in lodges}
+        key = normalize(lodge)
+        if key not in names:
+            close = difflib.get_close_matches(key, list(names), n=1, cutoff=MATCH_CUTOFF)
+            if not close:
+                return None
+            key = close[0]
+        return names[key], lodges[names[key]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Show or refresh the local catalog of parks and lodges")
+    parser.add_argument('--base-url', default=np_scraper.NPM_BASE_URL, help="Root of the permit web site. Default: {}".format(np_scraper.NPM_BASE_URL))
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG_PATH, help="Catalog file. Default: {}".format(DEFAULT_CATALOG_PATH))
+    parser.add_argument('--refresh', action='store_true', help="Fetch the catalog from the web site now")
+    parser.add_argument('-p', '--park', help="Only list the lodges of this park")
+    args = parser.parse_args(argv)
+
+    catalog = LodgeCatalog(args.base_url, args.catalog)
+    try:
+        if args.refresh:
+            catalog.refresh()
+        else:
+            catalog.ensure()
+    except Exception as ex:
+        print(str(ex))
+        return 1
+    print("{} 的目錄，{:.1f} 小時前更新".format(catalog.base_url, catalog.age() / 3600))
+    for name, park in catalog.entry['parks'].items():
+        if args.park and normalize(args.park) != normalize(name):
+            continue
+        print("{} (orgid {})：{}".format(name, park['orgid'], "、".join(park['lodges'])))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,495 +5,1002 @@
 # Author: David Wang
 # Copyright 2019
 
+from time import perf_counter
+started_at = perf_counter()
+
 import argparse
-import pandas as pd
-from pandas import ExcelWriter
-import openpyxl
-from openpyxl import load_workbook
-import requests
+import os
+import sys
 import re
-from lxml import html
-from bs4 import BeautifulSoup
-from selenium import webdriver
+import time
+from lxml import etree, html
 from datetime import date, datetime, timedelta
-from time import sleep
-from socket import error as SocketError
 import multiprocessing
 from multiprocessing import Pool
-from multiprocessing.pool import ThreadPool
-import functools
-from requests.auth import HTTPProxyAuth
-
-# Set up arguments for this program
-parser = argparse.ArgumentParser(description="Have fun dude!", formatter_class=argparse.RawTextHelpFormatter)
-parser.add_argument("-p", "--park", required=True, help="<Required> National Park that you plan to visit")
-parser.add_argument('-l','--lodge', required=True, nargs='+', help="<Required> One or more Lodge/Campsite where you plan to stay. For example: -l 三六九山莊 七卡山莊")
-parser.add_argument("-s", "--start", required=False, help="Use this parameter to query single date status. The query date must be 7 days later. Format example: 2019-02-02")
-parser.add_argument("-e", "--end", required=False, help="Use this parameter to query multiple date from startDate to endDate. Format example: 2019-02-22")
-parser.add_argument("-n", "--number", required=False, help="Team numbers that you plan to apply for permit. For example: -n 5")
-parser.add_argument("-r", "--retain", required=False, help="Check if still have retained room number for foreigner. Follow the -n argument. For example: -n 5 -r yes")
-
-# Combine all arguments into a list called args
-args = parser.parse_args()
-national_park = args.park
-lodge_campsite = args.lodge
-start_date = args.start
-end_date = args.end
-team_number = args.number
-check_retain = args.retain
-
-class TaiwanNationalParkWebParser:
-    def append_df_to_excel(self, filename, df, summarize, summarize_string, sheet_name='Selection', startrow=None, truncate_sheet=False, **to_excel_kwargs):
-        """Save table data to Excel/CSV or PDF file."""
-        # ignore [engine] parameter if it was passed
-        if 'engine' in to_excel_kwargs:
-            to_excel_kwargs.pop('engine')
-
-        writer = pd.ExcelWriter(filename, engine='openpyxl')
-
-        try:
-            # try to open an existing workbook
-            writer.book = load_workbook(filename)
-
-            # get the last row in the existing Excel sheet if it was not specified explicitly
-            if startrow is None and sheet_name in writer.book.sheetnames:
-                startrow = writer.book[sheet_name].max_row + 1
-
-            # truncate sheet
-            if truncate_sheet and sheet_name in writer.book.sheetnames:
-                # index of [sheet_name] sheet
-                idx = writer.book.sheetnames.index(sheet_name)
-                # remove [sheet_name]
-                writer.book.remove(writer.book.worksheets[idx])
-                # create an empty sheet [sheet_name] using old index
-                writer.book.create_sheet(sheet_name, idx)
-
-            # copy existing sheets
-            writer.sheets = {ws.title:ws for ws in writer.book.worksheets}
-        except FileNotFoundError:
-            # file does not exist yet, we will create it
-            pass
-
-        if startrow is None:
-            startrow = 0
+from collections import namedtuple
+from urllib.parse import urlparse
+import http_session
+import rate_limiter
+import response_cache
+import scan_metrics
+# pandas, openpyxl, BeautifulSoup, NumPy (availability) and asyncio are imported by the code paths that need them
+
+# Root of the Nation Park Permit Application System, overridable to point a scan at a stand-in server
+NPM_BASE_URL = os.environ.get('NPM_BASE_URL', 'https://npm.cpami.gov.tw')
+
+# Startup phases and their duration in seconds, reported by --timing
+timings = [('imports', perf_counter() - started_at)]
+
+def mark(phase, since):
+    """Record how long a startup phase took since the perf_counter() value 'since', and return now."""
+    now = perf_counter()
+    timings.append((phase, now - since))
+    return now
+
+# Lodge list page and check bed page of each National Park
+PARK_PAGES = {
+    '玉山': ("bed_6.aspx", "bed_6main.aspx"),
+    '雪霸': ("bed_1.aspx", "bed_1main.aspx"),
+    '太魯閣': ("bed_4.aspx", "bed_4main.aspx"),
+}
+
+# 玉山 bed page counters that tell whether the lottery of the date is already drawn
+approved_pattern = re.compile(r'id="ContentPlaceHolder1_lbStatus_4"[^>]*>\s*(\d+)')
+
+def page_type_of(url, text):
+    """
+    Pick the response cache page type, a bed page whose lottery is drawn (已抽完籤) is kept longer. Only
+    approved teams show the draw; a page with none, such as a date not open yet, keeps the live 'bed' TTL.
+    """
+    page_type = response_cache.page_type_of(url)
+    if page_type == 'bed':
+        approved = approved_pattern.search(text)
+        if approved and int(approved.group(1)) > 0:
+            page_type = 'bed_drawn'
+    return page_type
+
+# Precompiled lookups of the lxml extraction path, every ContentPlaceHolder1_* field is read in one pass
+FIELD_ID_PREFIX = "ContentPlaceHolder1_"
+field_id_pattern = re.compile("^" + FIELD_ID_PREFIX)
+field_xpath = etree.XPath('//span[starts-with(@id, "{}")]'.format(FIELD_ID_PREFIX))
+datam_xpath = etree.XPath('//table[contains(concat(" ", normalize-space(@class), " "), " DATAM ")]')
+row_xpath = etree.XPath('.//tr')
+cell_xpath = etree.XPath('./th | ./td')
+orgid_link_xpath = etree.XPath('//ul/li/a[starts-with(@href, "apply_1_2.aspx?unit=")]')
+lodge_option_xpath = etree.XPath('//option[@value]')
+
+def parse_html(text):
+    """lxml document of a page."""
+    try:
+        return html.fromstring(text)
+    except ValueError:
+        # lxml refuses str input that carries an XML encoding declaration
+        return html.fromstring(text.encode('utf-8'), parser=html.HTMLParser(encoding='utf-8'))
+
+def table_rows(table):
+    """Return the (th texts, td texts) of every row of a DATAM table parsed by lxml or BeautifulSoup."""
+    rows = []
+    if isinstance(table, etree._Element):
+        for row in row_xpath(table):
+            title_cells, cells = [], []
+            for cell in cell_xpath(row):
+                (title_cells if cell.tag == 'th' else cells).append(cell.text_content())
+            rows.append((title_cells, cells))
+    else:
+        for row in table.find_all('tr'):
+            rows.append(([th.get_text() for th in row.find_all('th')], [td.get_text() for td in row.find_all('td')]))
+    return rows
+
+# Verbose scans show a DATAM table the way pandas truncates its repr: every row up to PREVIEW_MAX_ROWS,
+# else the first and last PREVIEW_MIN_ROWS / 2
+PREVIEW_MAX_ROWS = 60
+PREVIEW_MIN_ROWS = 10
+
+def table_preview(table):
+    """Text of a TableRows for a verbose scan, long tables cut to their head and tail."""
+    rows = [" │ ".join(map(str, row)) for row in table.rows]
+    if len(rows) > PREVIEW_MAX_ROWS:
+        half = PREVIEW_MIN_ROWS // 2
+        rows = rows[:half] + ["..."] + rows[-half:] + ["[{} rows x {} columns]".format(len(table.rows), len(table.columns))]
+    return "\n".join([" │ ".join(map(str, table.columns))] + rows)
+
+def table_columns(records, n_columns):
+    """Turn row tuples into n_columns column lists, all-digit columns such as headcount become ints."""
+    import pandas as pd
+    column_lists = {}
+    for n in range(n_columns):
+        values = [record[n] if n < len(record) else None for record in records]
+        stripped = [value.strip() if value is not None else '' for value in values]
+        if len(values) > 0 and all(value.isdigit() for value in stripped):
+            column_lists[n] = pd.array([int(value) for value in stripped], dtype='int64')
+        else:
+            column_lists[n] = pd.array(values, dtype=object)
+    return column_lists
 
-        # write out table data to the sheet
-        df.to_excel(writer, sheet_name, startrow=startrow, **to_excel_kwargs)
+def init_worker(session_settings, cache_settings, limiter_settings=None, limiters=None):
+    """Set up the HTTP session, response cache and rate limiters of a Pool worker like the ones of the parent process."""
+    http_session.configure(**session_settings)
+    response_cache.configure(**cache_settings)
+    if limiter_settings is not None:
+        rate_limiter.configure(**limiter_settings)
+        rate_limiter.install(limiters)
 
-        # write the summarize data below table data
-        newrow = writer.book[sheet_name].max_row
+# DATAM table without pandas: column titles and one tuple of cell texts per row
+TableRows = namedtuple('TableRows', ['columns', 'rows'])
 
-        # define summarize data string and write it to the sheet
-        writer.book[sheet_name].cell(row = newrow+1, column = 1).value = summarize_string
+# Outcome of one (lodge, date) query. available is 1/0 when a team number was given, None otherwise,
+# table is the DATAM table as a DataFrame with as_frame or as TableRows, None when the page has no table
+CellResult = namedtuple('CellResult', ['lodge_id', 'search_date', 'available', 'summarize', 'table'])
 
-        # save the workbook
-        writer.save()
+class TaiwanNationalParkWebParser:
+    def __init__(self, national_park=None, team_number=None, check_retain=None, page_parser='lxml', as_frame=False, verbose=True, **kwargs):
+        self.national_park = national_park
+        self.team_number = team_number
+        self.check_retain = check_retain
+        self.page_parser = page_parser
+        self.as_frame = as_frame
+        self.verbose = verbose
 
     def parse_orgid(self, url):
         """Parsing org_id for specific National Park."""
-        headers = {'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/53.0.2785.143 Safari/537.36'}
         try:
-            resp = requests.get(url, headers=headers, timeout=10)
-            if resp.status_code == 200:
-                resp.encoding = resp.apparent_encoding
-                soup = BeautifulSoup(resp.text, 'lxml')
-                items = soup.select('ul > li > a[href^="apply_1_2.aspx?unit="]')
-                for i in items:
-                    if national_park not in str(i):
-                        continue
+            text = self.fetch_page(url)
+            if text is not None:
+                for name, orgid in parse_orgids(text):
                     # Get orgid for selected national park
-                    return str(i.get('href').replace('apply_1_2.aspx?unit=', ''))
+                    if self.national_park in name:
+                        return orgid
         except Exception as ex:
-            print(str(ex))
+            if self.verbose:
+                print(str(ex))
 
     def get_lodge_list(self, url):
         """Get the lodge/campsite list and its id by National Park."""
-        headers = {'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/53.0.2785.143 Safari/537.36'}
         try:
-            resp = requests.get(url, headers=headers, timeout=10)
-            if resp.status_code == 200:
-                resp.encoding = resp.apparent_encoding
-                soup = BeautifulSoup(resp.text, 'lxml')
-                items = soup.select('option[value^=""]')
-                lodge_ids = [item.get('value') for item in items]
-                lodge_names = [item.text for item in items]
-                lodge_camp_list = dict(zip(lodge_names, lodge_ids))
-                return lodge_camp_list
+            text = self.fetch_page(url)
+            if text is not None:
+                return parse_lodge_list(text)
         except Exception as ex:
-            print(str(ex))
+            if self.verbose:
+                print(str(ex))
+
+    def fetch_page(self, url):
+        """Return the HTML text of a page from the response cache or the web site, or None if the server did not answer 200."""
+        text = response_cache.get(url)
+        if text is not None:
+            return text
+        resp = http_session.get(url)
+        if resp.status_code == 200:
+            text = http_session.decode(resp)
+            response_cache.put(url, text, page_type_of(url, text))
+            return text
+
+    def fetch_measured(self, url, record):
+        """fetch_page, adding the fetch time and the network timing of the request to a scan_metrics record."""
+        started = perf_counter()
+        http_session.clear_timing()
+        try:
+            text = self.fetch_page(url)
+        finally:
+            record['fetch_s'] = perf_counter() - started
+        scan_metrics.add_timing(record, http_session.last_timing())
+        return text
+
+    def measure_url(self, url, np, lodge_id, queued_at=None):
+        """parse_url that also returns the scan_metrics record of the query, as (CellResult or None, record)."""
+        record = scan_metrics.new_record(url, lodge_id, queued_at)
+        try:
+            text = self.fetch_measured(url, record)
+            if text is not None:
+                started = perf_counter()
+                cell = self.parse_page(text, np, lodge_id)
+                record['parse_s'] = perf_counter() - started
+                return cell, record
+        except Exception as ex:
+            record['error'] = str(ex)
+            if self.verbose:
+                print(str(ex))
+        return None, record
 
     def parse_url(self, url, np, lodge_id):
         """Parsing web content, and extract the required information from XML and HTML structures."""
-        headers = {'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/53.0.2785.143 Safari/537.36'}
-        try:
-            resp = requests.get(url, headers=headers, timeout=10)
-            if resp.status_code == 200:
-                resp.encoding = resp.apparent_encoding
-                soup = BeautifulSoup(resp.text, 'lxml')
-                # First check if this page exist
-                if soup.find("span", id="ContentPlaceHolder1_sdate") == None:
-                    print("您所查詢的宿營地，於該日未開放查詢！")
-                    return {lodge_id:0}
-                # Parsing web data
-                search_date = soup.find("span", id="ContentPlaceHolder1_sdate").text
-                national_park = soup.find("span", id="ContentPlaceHolder1_org").text
-                lodge = soup.find("span", id="ContentPlaceHolder1_room").text
-                table = soup.find("table", class_="DATAM")
-                #lodge_available_list[lodge_id] = []
-                if np == "玉山":
-                    # 餘額
-                    current_available = soup.find("span", id="ContentPlaceHolder1_lbCnt1").text
-                    current_available = current_available.replace('(', '').replace(')', '').split(',')[0]
-                    # 乘載量
-                    pool_total = soup.find("span", id="ContentPlaceHolder1_lbCnt").text
-                    pool_total = pool_total.replace('(', '').replace(')', '').split(',')[0]
-                    # 排隊預約
-                    queue = soup.find("span", id="ContentPlaceHolder1_lbStatus_6").text
-                    # 審核中
-                    examine = soup.find("span", id="ContentPlaceHolder1_lbCnt2").text
-                    # 核准入園
-                    approved = soup.find("span", id="ContentPlaceHolder1_lbStatus_4").text
-                    # 共計
-                    total_applicant = int(queue) + int(examine)
-                    # 中籤率
-                    if int(queue) == 0 and int(examine) == 0 and int(approved) == 0:
-                        # The date has preserved and can't apply permit
-                        percentage = 'N/A'
+        return self.measure_url(url, np, lodge_id)[0]
+
+    def measure_task(self, task):
+        """measure_url of a (position, url, np, lodge_id, queued_at) task, for imap_unordered: (position, (cell, record))."""
+        position, url, np, lodge_id, queued_at = task
+        return position, self.measure_url(url, np, lodge_id, queued_at)
+
+    def extract_page(self, text):
+        """Parse a bed page once, return its ContentPlaceHolder1_* span texts keyed by the id suffix and its DATAM table."""
+        fields = {}
+        if self.page_parser == 'bs4':
+            from bs4 import BeautifulSoup
+            soup = BeautifulSoup(text, 'lxml')
+            for span in soup.find_all("span", id=field_id_pattern):
+                fields.setdefault(span['id'][len(FIELD_ID_PREFIX):], span.text)
+            return fields, soup.find("table", class_="DATAM")
+
+        doc = parse_html(text)
+        for span in field_xpath(doc):
+            fields.setdefault(span.get('id')[len(FIELD_ID_PREFIX):], span.text_content())
+        tables = datam_xpath(doc)
+        return fields, tables[0] if tables else None
+
+    def parse_page(self, text, np, lodge_id):
+        """Extract the required information from a downloaded bed page."""
+        fields, table = self.extract_page(text)
+        # First check if this page exist
+        if fields.get("sdate") == None:
+            if self.verbose:
+                print("您所查詢的宿營地，於該日未開放查詢！")
+            return CellResult(lodge_id, None, 0, None, None)
+        # Parsing web data
+        search_date = fields["sdate"]
+        national_park = fields["org"]
+        lodge = fields["room"]
+        df = None
+        if np == "玉山":
+            # 餘額
+            current_available = fields["lbCnt1"]
+            current_available = current_available.replace('(', '').replace(')', '').split(',')[0]
+            # 乘載量
+            pool_total = fields["lbCnt"]
+            pool_total = pool_total.replace('(', '').replace(')', '').split(',')[0]
+            # 排隊預約
+            queue = fields["lbStatus_6"]
+            # 審核中
+            examine = fields["lbCnt2"]
+            # 核准入園
+            approved = fields["lbStatus_4"]
+            # 共計
+            total_applicant = int(queue) + int(examine)
+            # 中籤率
+            percentage = self.draw_percentage(pool_total, queue, examine, approved)
+
+            summarize = {'search_date': search_date,'national_park' : national_park, 'lodge' : lodge, 'current_available' : current_available, 'pool_total' : pool_total, 'queue' : queue, 'examine' : examine, 'approved' : approved, 'total_applicant' : total_applicant, 'percentage' : percentage}
+            summarize_string = "{} {} {}\n餘額：{} │ 承載量：{} │ 排隊預約： {}位 │ 審核中： {}位 │ 核准入園：{}位 ，共計：{}位，中籤率約為 {} %。\n".format(search_date, national_park, lodge, current_available, pool_total, queue, examine, approved, total_applicant, percentage)
+        elif np == "雪霸":
+            # 乘載量
+            pool_total = fields["lblsumrooms"]
+            # 待處理
+            queue = fields["lblchkrooms"]
+            # 補件
+            wait = fields["docpeople"]
+            # 核准入園
+            approved = fields["lblsubrooms"]
+            # 待系統排定
+            tbd = fields["lblsystemwait"]
+            # 候補
+            candidate = fields["lblbakrooms"]
+            # 餘額
+            current_available = fields["lbloverrooms"]
+            summarize = {'search_date': search_date,'national_park' : national_park, 'lodge' : lodge, 'pool_total' : pool_total, 'queue' : queue, 'wait' : wait, 'approved' : approved, 'tbd' : tbd, 'candidate' : candidate, 'current_available' : current_available}
+            summarize_string = "{} {} {}\n餘額：{}床位 │ 承載量：{} │ 待處理： {}床位 │ 補件： {}床位 │ 已通過：{}床位 | 待系統排定：{}床位 │ 宿營地不足後補：{}床位\n".format(search_date, national_park, lodge, current_available, pool_total, queue, wait, approved, tbd, candidate)
+        elif np == "太魯閣":
+            # 乘載量
+            pool_total = fields["lblsumrooms"]
+            # 核准入園
+            approved = fields["lblsubrooms"]
+            # 待審核
+            tbd = fields["lblchkrooms"]
+            # 餘額
+            current_available = fields["lbloverrooms"]
+            summarize = {'search_date': search_date,'national_park' : national_park, 'lodge' : lodge, 'pool_total' : pool_total, 'approved' : approved, 'tbd' : tbd, 'current_available' : current_available}
+            summarize_string = "{} {} {}\n餘額：{}床位 │ 承載量：{} │ 通過審核： {}床位 │ 待審核： {}床位\n".format(search_date, national_park, lodge, current_available, pool_total, approved, tbd)
+
+        #Parsing and return detail table data from webpage
+        if table != None:
+            df = self.parse_html_table(table, summarize, summarize_string, as_frame=self.as_frame)
+        available = self.cell_available(np, summarize, df)
+        if table != None:
+            if self.verbose:
+                print(summarize_string, [df] if self.as_frame else table_preview(df))
+        elif self.verbose:
+            print(summarize_string, "已保留{}{}床位，供活動暨工作人員使用".format(search_date, lodge))
+
+        return CellResult(lodge_id, search_date, available, summarize, df)
+
+    def draw_percentage(self, pool_total, queue, examine, approved):
+        """中籤率 of a 玉山 bed page for the team of this parser: a percentage, 'N/A' or '已抽完籤'."""
+        if int(queue) == 0 and int(examine) == 0 and int(approved) == 0:
+            # The date has preserved and can't apply permit
+            return 'N/A'
+        # The drew lots result not public yet (Date after 30 days)
+        if int(approved) == 0 and int(queue) > 0:
+            percentage = 100*(int(pool_total) / int(queue))
+            return 100 if percentage > 100 else percentage
+        if self.team_number and not self.check_retain:
+            return 100 if int(pool_total) - (int(queue) + int(examine) + int(approved)) > int(self.team_number) else 0
+        return '已抽完籤'
+
+    def cell_available(self, np, summarize, df):
+        """
+        1 if the team of this parser can apply on a parsed bed page, else 0, None without a team number. Only
+        needs the summarize dict and DATAM table of a CellResult, so one parsed page serves any team number.
+        """
+        if not self.team_number or summarize is None:
+            return None
+        available = None
+        current_available = summarize['current_available']
+        if np == "玉山":
+            queue, examine, approved = summarize['queue'], summarize['examine'], summarize['approved']
+            # Check if can apply permit by team number
+            if not self.check_retain:
+                if int(current_available) > int(queue) and int(current_available) - int(queue) >= int(self.team_number):
+                    if df is None:
+                        available = 0
                     else:
-                        # The drew lots result not public yet (Date after 30 days)
-                        if int(approved) == 0 and int(queue) > 0:
-                            percentage = 100*(int(pool_total) / int(queue))
-                            percentage = 100 if percentage > 100 else percentage
-                        else:
-                            if team_number and not check_retain:
-                                percentage = 100 if int(pool_total) - (int(queue) + int(examine) + int(approved)) > int(team_number) else 0
-                            else:
-                                percentage = '已抽完籤'
-
-                    summarize = {'search_date': search_date,'national_park' : national_park, 'lodge' : lodge, 'current_available' : current_available, 'pool_total' : pool_total, 'queue' : queue, 'examine' : examine, 'approved' : approved, 'total_applicant' : total_applicant, 'percentage' : percentage}
-                    summarize_string = "{} {} {}\n餘額：{} │ 承載量：{} │ 排隊預約： {}位 │ 審核中： {}位 │ 核准入園：{}位 ，共計：{}位，中籤率約為 {} %。\n".format(search_date, national_park, lodge, current_available, pool_total, queue, examine, approved, total_applicant, percentage)
-
-                    # Check if can apply permit by team number
-                    if team_number and not check_retain:
-                        if int(current_available) > int(queue) and int(current_available) - int(queue) >= int(team_number):
-                            if soup.find("table", class_="DATAM") == None:
-                                lodge_available_list.update({lodge_id:0})
-                                #lodge_available_list.update({lodge_id : {search_date : 0}})
-                            else:
-                                lodge_available_list.update({lodge_id:1})
-                                #lodge_available_list.update({lodge_id : {search_date : 1}})
-                        else:
-                            # Date that not draw lots yet. Everyone can still apply permit
-                            if int(queue) > 0 and int(examine) == 0 and int(approved) == 0:
-                                lodge_available_list.update({lodge_id:1})
-                                #lodge_available_list.update({lodge_id : {search_date : 1}})
-                            else:
-                                lodge_available_list.update({lodge_id:0})
-                                #lodge_available_list.update({lodge_id : {search_date : 0}})
-
-                    # Check if can apply retain permit by foreigner team number
-                    if team_number and check_retain:
-                        if table != None:
-                            retain_number = 0
-                            for row in table.find_all("tr"):
-                                columns = row.find_all('td')
-                                combinaiton = dict(enumerate(columns))
-                                if "外籍提前保留名額" in str(combinaiton.get(9)) or "外籍提前申請" in str(combinaiton.get(9)):
-                                    retain_number += int(combinaiton.get(6).get_text())
-                            if 24 - int(retain_number) >=  int(team_number):
-                                lodge_available_list.update({lodge_id:1})
-                                print("尚餘可申請外籍保留名額：{}位".format(24 - int(retain_number)))
-                            else:
-                                lodge_available_list.update({lodge_id:0})
-                                print("尚餘可申請外籍保留名額：0位")
-                        else:
-                            lodge_available_list.update({lodge_id:0})
-                elif np == "雪霸":
-                    # 乘載量
-                    pool_total = soup.find("span", id="ContentPlaceHolder1_lblsumrooms").text
-                    # 待處理
-                    queue = soup.find("span", id="ContentPlaceHolder1_lblchkrooms").text
-                    # 補件
-                    wait = soup.find("span", id="ContentPlaceHolder1_docpeople").text
-                    # 核准入園
-                    approved = soup.find("span", id="ContentPlaceHolder1_lblsubrooms").text
-                    # 待系統排定
-                    tbd = soup.find("span", id="ContentPlaceHolder1_lblsystemwait").text
-                    # 候補
-                    candidate = soup.find("span", id="ContentPlaceHolder1_lblbakrooms").text
-                    # 餘額
-                    current_available = soup.find("span", id="ContentPlaceHolder1_lbloverrooms").text
-                    summarize = {'search_date': search_date,'national_park' : national_park, 'lodge' : lodge, 'pool_total' : pool_total, 'queue' : queue, 'wait' : wait, 'approved' : approved, 'tbd' : tbd, 'candidate' : candidate, 'current_available' : current_available}
-                    summarize_string = "{} {} {}\n餘額：{}床位 │ 承載量：{} │ 待處理： {}床位 │ 補件： {}床位 │ 已通過：{}床位 | 待系統排定：{}床位 │ 宿營地不足後補：{}床位\n".format(search_date, national_park, lodge, current_available, pool_total, queue, wait, approved, tbd, candidate)
-
-                    # Check if you can apply permit with team_number in the preferred date range
-                    if team_number:
-                        if int(current_available) > 0 and int(current_available) - int(tbd) >= int(team_number):
-                            lodge_available_list.update({lodge_id:1})
-                        else:
-                            lodge_available_list.update({lodge_id:0})
-                elif np == "太魯閣":
-                    # 乘載量
-                    pool_total = soup.find("span", id="ContentPlaceHolder1_lblsumrooms").text
-                    # 核准入園
-                    approved = soup.find("span", id="ContentPlaceHolder1_lblsubrooms").text
-                    # 待審核
-                    tbd = soup.find("span", id="ContentPlaceHolder1_lblchkrooms").text
-                    # 餘額
-                    current_available = soup.find("span", id="ContentPlaceHolder1_lbloverrooms").text
-                    summarize = {'search_date': search_date,'national_park' : national_park, 'lodge' : lodge, 'pool_total' : pool_total, 'approved' : approved, 'tbd' : tbd, 'current_available' : current_available}
-                    summarize_string = "{} {} {}\n餘額：{}床位 │ 承載量：{} │ 通過審核： {}床位 │ 待審核： {}床位\n".format(search_date, national_park, lodge, current_available, pool_total, approved, tbd)
-
-                    # Check if you can apply permit with team_number in the preferred date range
-                    if team_number:
-                        if int(current_available) > 0 and int(current_available) >= int(team_number):
-                            lodge_available_list.update({lodge_id:1})
-                        else:
-                            lodge_available_list.update({lodge_id:0})
-
-                #Parsing and return detail table data from webpage
-                if table != None:
-                    print(summarize_string, [(self.parse_html_table(soup.find_all("table", class_="DATAM")[0], summarize, summarize_string))])
+                        available = 1
                 else:
-                    print(summarize_string, "已保留{}{}床位，供活動暨工作人員使用".format(search_date, lodge))
-
-                return lodge_available_list
+                    # Date that not draw lots yet. Everyone can still apply permit
+                    if int(queue) > 0 and int(examine) == 0 and int(approved) == 0:
+                        available = 1
+                    else:
+                        available = 0
 
-        except Exception as ex:
-            print(str(ex))
+            # Check if can apply retain permit by foreigner team number
+            else:
+                if df is not None:
+                    import export
+                    retain_number = 0
+                    for cells in export.table_rows_of(df)[1]:
+                        combinaiton = dict(enumerate(cells))
+                        if "外籍提前保留名額" in str(combinaiton.get(9)) or "外籍提前申請" in str(combinaiton.get(9)):
+                            retain_number += int(combinaiton.get(6))
+                    if 24 - int(retain_number) >=  int(self.team_number):
+                        available = 1
+                        if self.verbose:
+                            print("尚餘可申請外籍保留名額：{}位".format(24 - int(retain_number)))
+                    else:
+                        available = 0
+                        if self.verbose:
+                            print("尚餘可申請外籍保留名額：0位")
+                else:
+                    available = 0
+        elif np == "雪霸":
+            # Check if you can apply permit with self.team_number in the preferred date range
+            if int(current_available) > 0 and int(current_available) - int(summarize['tbd']) >= int(self.team_number):
+                available = 1
+            else:
+                available = 0
+        elif np == "太魯閣":
+            # Check if you can apply permit with self.team_number in the preferred date range
+            if int(current_available) > 0 and int(current_available) >= int(self.team_number):
+                available = 1
+            else:
+                available = 0
+        return available
+
+    async def parse_urls_async(self, inquire_task_list, host_limit=100, parse_workers=0, on_result=None):
+        """
+        Fetch every (url, np, lodge_id, queued_at) task from one process with at most host_limit requests in flight
+        per host, and return a (CellResult or None, scan_metrics record) pair per task. on_result(position, cell,
+        record) is called as soon as each task is done.
+        """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        loop = asyncio.get_running_loop()
+        hosts = {urlparse(task[0]).netloc for task in inquire_task_list}
+        host_semaphores = {host: asyncio.Semaphore(host_limit) for host in hosts}
+        # requests is blocking, so the sockets in flight are driven by a thread executor sized to the host limits
+        fetch_executor = ThreadPoolExecutor(max_workers=max(1, host_limit * len(hosts)))
+        # Parsing only goes to worker processes when asked for, it is cheap next to the network wait
+        parse_executor = ProcessPoolExecutor(max_workers=parse_workers) if parse_workers else None
+
+        async def run_task(position, url, np, lodge_id, queued_at):
+            cell, record = await measure_task(url, np, lodge_id, queued_at)
+            if on_result:
+                on_result(position, cell, record)
+            return cell, record
+
+        async def measure_task(url, np, lodge_id, queued_at):
+            record = scan_metrics.new_record(url, lodge_id, queued_at)
+            try:
+                async with host_semaphores[urlparse(url).netloc]:
+                    # Time spent waiting for a free slot of the host is the queue wait of the async engine
+                    record['queue_wait_s'] = time.time() - queued_at
+                    text = await loop.run_in_executor(fetch_executor, self.fetch_measured, url, record)
+                if text is None:
+                    return None, record
+                started = perf_counter()
+                if parse_executor:
+                    cell = await loop.run_in_executor(parse_executor, self.parse_page, text, np, lodge_id)
+                else:
+                    cell = self.parse_page(text, np, lodge_id)
+                record['parse_s'] = perf_counter() - started
+                return cell, record
+            except Exception as ex:
+                record['error'] = str(ex)
+                if self.verbose:
+                    print(str(ex))
+                return None, record
 
-    def parse_html_table(self, table, summarize, sum_string):
-        """Parse table data from web site."""
-        n_columns = 0
-        n_rows=0
+        try:
+            return await asyncio.gather(*[run_task(position, *task) for position, task in enumerate(inquire_task_list)])
+        finally:
+            fetch_executor.shutdown(wait=False)
+            if parse_executor:
+                parse_executor.shutdown(wait=False)
+
+    def parse_html_table(self, table, summarize, sum_string, as_frame=True):
+        """Parse table data from web site, as a DataFrame or as TableRows of plain row tuples when as_frame is False."""
         column_names = []
+        records = []
 
-        # Find number of rows and columns
-        # we also find the column titles if we can
-        for row in table.find_all('tr'):
-            # Determine the number of rows in the table
-            td_tags = row.find_all('td')
-            if len(td_tags) > 0:
-                n_rows+=1
-                if n_columns == 0:
-                    # Set the number of columns for our table
-                    n_columns = len(td_tags)
-
-            # Handle column titles if we find them
-            title_tags = row.find_all("th")
-            if len(title_tags) > 0: #and len(column_names)-1 == 0:
+        # One pass over the rows collects the column titles and the cell texts of every row
+        for title_tags, td_tags in table_rows(table):
+            if len(title_tags) > 0:
                 for th in title_tags:
-                    column_names.append(th.get_text().replace('\r', '').replace('\n', '').replace('\t', ''))
+                    column_names.append(th.replace('\r', '').replace('\n', '').replace('\t', ''))
+            if len(td_tags) > 0:
+                records.append(tuple(td_tags))
+        n_columns = len(records[0]) if len(records) > 0 else 0
 
         # Safeguard on Column Titles
         if len(column_names) > 0 and len(column_names) != n_columns:
             #raise Exception("Column titles do not match the number of columns")
-            print("此日期尚無隊伍資料，或尚未開放申請入園")
+            if self.verbose:
+                print("此日期尚無隊伍資料，或尚未開放申請入園")
 
         columns = column_names if len(column_names) > 0 else range(0, n_columns)
-        df = pd.DataFrame(columns = columns, index= range(0, n_rows))
-        row_marker = 0
-        #preserved = 0
-        for row in table.find_all("tr"):
-            column_marker = 0
-            columns = row.find_all('td')
-            #combinaiton = dict(zip(column_names, columns))
-            #print("combinaiton =", combinaiton)
-            #if "外籍提前保留名額" in str(combinaiton.get(column_names[9])):
-            #    preserved += int(combinaiton.get(column_names[6]).get_text())
-
-            for column in columns:
-                df.iat[row_marker, column_marker] = column.get_text()
-                column_marker += 1
-            if len(columns) > 0:
-                row_marker += 1
-        #print("preserved=", preserved)
-
-        # Write Pandas DF to Excel
-        excel_file = "山屋申請查詢.xlsx"
-        sheet_name = "入園申請查詢表"
-        #self.append_df_to_excel(excel_file, df, summarize, sum_string, sheet_name=sheet_name)
-
-        #writer = ExcelWriter('WebDataExport.xlsx')
-        #df.to_excel(writer, 'SharesSelection')
-        #writer.save()
-
-        # Write Pandas DF to CSV
-        #df.to_csv('WebDataExport.csv', sep=',')
+        if not as_frame:
+            return TableRows(list(columns), records)
 
+        import pandas as pd
+        df = pd.DataFrame(table_columns(records, len(columns)))
+        df.columns = columns
+        # Tables are written to Excel/CSV all at once after the scan, see export.write_scan
         return df
 
-    def check_available_apply_date(self):
+    def check_available_apply_date(self, lodge_available_list={}, lodge_campsite=[], date_range=[], itinerary=None):
         """Check available apply date by given team number, lodge/campsite arrangement and date range."""
-        available_date_list = []
-        available_date = []
-        for item in lodge_available_list.values():
-            available_date_list.append(item)
-
-        N = 1 if len(date_range)-len(lodge_campsite) == 0 else len(date_range)-len(lodge_campsite)
-        for n in range(N):
-            tmp = []
-            [tmp.append(available_date_list[a][n+a]) for a in range(len(available_date_list))]
-            #for a in range(len(available_date_list)):
-            #    tmp.append(available_date_list[a][n+a])
-            if tmp == [1] * len(lodge_campsite):
-                # Filtering only that are series days between Sunday and Thrusday and have retained numbers
-                if check_retain and len(lodge_campsite) > 1:
-                    tmp = date_range[n+len(lodge_campsite)].split('-')
-                    tmp[0] = str(int(tmp[0])+1911)
-                    common_date_end = "-".join(tmp)
-
-                    tmp = date_range[n].split('-')
-                    tmp[0] = str(int(tmp[0])+1911)
-                    common_date_start = "-".join(tmp)
-
-                    day_range = datetime.strptime(common_date_end, '%Y-%m-%d') - datetime.strptime(common_date_start, '%Y-%m-%d')
-                    if  day_range.days > len(lodge_campsite):
-                        continue
-                available_date.append(date_range[n])
-                print(date_range[n], "尚可申請入園")
-            else:
-                tmp.clear()
+        import availability
+        itinerary = itinerary or availability.default_itinerary(len(lodge_campsite))
+        matrix = availability.availability_matrix(lodge_available_list.values(), len(date_range))
+
+        starts = availability.window_starts(matrix, itinerary, self.window_count(lodge_campsite, date_range))
+        # Filtering only that are series days between Sunday and Thrusday and have retained numbers
+        if self.check_retain and len(lodge_campsite) > 1:
+            starts = availability.consecutive_starts(availability.roc_date_ordinals(date_range), starts, len(lodge_campsite))
+
+        available_date = [date_range[n] for n in starts]
+        if self.verbose:
+            for n in available_date:
+                print(n, "尚可申請入園")
         return available_date
 
+    def window_count(self, lodge_campsite, date_range):
+        """Number of start days check_available_apply_date looks at."""
+        return 1 if len(date_range)-len(lodge_campsite) == 0 else len(date_range)-len(lodge_campsite)
+
+    def window_tracker(self, lodge_campsite, date_range, itinerary=None):
+        """Return an availability.WindowTracker that finds the dates of check_available_apply_date cell by cell."""
+        import availability
+        itinerary = itinerary or availability.default_itinerary(len(lodge_campsite))
+        ordinals = None
+        if self.check_retain and len(lodge_campsite) > 1:
+            ordinals = availability.roc_date_ordinals(date_range)
+        return availability.WindowTracker(len(lodge_campsite), len(date_range), itinerary,
+                                          self.window_count(lodge_campsite, date_range), ordinals, len(lodge_campsite))
+
+
+class ScanResult:
+    """Outcome of one scan: every (lodge, date) cell, the availability per lodge and the dates a team can apply for."""
+    def __init__(self, national_park, lodge_campsite, date_range, cells, available_date=None, records=None, metrics=None):
+        self.national_park = national_park
+        self.lodge_campsite = lodge_campsite
+        self.date_range = date_range
+        self.cells = cells
+        self.available_date = available_date or []
+        # scan_metrics records of every query and their summary
+        self.records = records or []
+        self.metrics = metrics
+        # (lodge, date, attempts, error) of the cells that could not be answered
+        self.failures = []
+        # (name asked for, catalog name) of the lodge names the catalog corrected
+        self.corrections = []
+        # Id of the scan in its scan_journal, None without a journal
+        self.scan_id = None
+        # Key the results back to each lodge, in date order
+        self.lodge_available_list = {lodge: [] for lodge in range(len(lodge_campsite))}
+        for n, cell in enumerate(cells):
+            self.lodge_available_list[n // len(date_range)].append(cell.available if cell else None)
+
+
+def cell_to_data(cell):
+    """Turn a CellResult into plain JSON data for the scan journal."""
+    data = {'lodge_id': cell.lodge_id, 'search_date': cell.search_date, 'available': cell.available, 'summarize': cell.summarize, 'table': None}
+    if cell.table is not None:
+        import export
+        columns, rows = export.table_rows_of(cell.table)
+        data['table'] = {'columns': columns, 'rows': [[export.plain(value) for value in row] for row in rows]}
+    return data
+
+
+def cell_from_data(data, as_frame=False):
+    """Turn scan journal data back into a CellResult, its table as TableRows or as a DataFrame with as_frame."""
+    table = data['table']
+    if table is not None:
+        rows = [tuple(row) for row in table['rows']]
+        if as_frame:
+            import pandas as pd
+            df = pd.DataFrame(table_columns([tuple(str(value) for value in row) for row in rows], len(table['columns'])))
+            df.columns = table['columns']
+            table = df
+        else:
+            table = TableRows(table['columns'], rows)
+    return CellResult(data['lodge_id'], data['search_date'], data['available'], data['summarize'], table)
+
+
+def worker_initargs():
+    """Pool initargs for init_worker that copy the settings and share the rate limiters of this process."""
+    return (http_session.settings(), response_cache.settings(), rate_limiter.settings(), rate_limiter.limiters())
 
-# In the first instance we check the web site connection
-check_url = 'https://npm.cpami.gov.tw/bed_menu.aspx'
-headers = {'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_6) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/53.0.2785.143 Safari/537.36'}
-try:
-    r = requests.get(check_url, timeout=10)
-    if r.status_code == 200:
-        print('Check connect OK')
-except Exception as ex:
-    print(str(ex))
-    exit(0)
-
-# Check if start_data and end_date correctly
-if check_retain:
-    check_start_date = datetime.strftime(date.today() + timedelta(days=35), "%Y-%m-%d")
-    check_end_date = datetime.strftime(date.today() + timedelta(days=120), "%Y-%m-%d")
-    if  start_date and start_date < check_start_date or end_date and end_date > check_end_date:
-        print("外籍保留名額提前申請期限：預定入園日期前35天至前4個月間提出申請")
-        print("外籍保留名額可申請日期為：{} 到 {}".format(check_start_date, check_end_date))
-        exit(0)
-
-# Set start_data and end_date
-if start_date and end_date:
-    day_range = datetime.strptime(end_date, '%Y-%m-%d') - datetime.strptime(start_date, '%Y-%m-%d')
-    if day_range.days < len(lodge_campsite):
-        print("您輸入了{}個山屋/營地名稱，請至少以{}天行程來查詢床位".format(len(lodge_campsite), len(lodge_campsite)+1))
-        exit(0)
-elif not start_date and not end_date:
+
+def check_connection(check_url=None, verbose=False):
+    """Check the web site connection, return True when it answers."""
+    check_url = check_url or "{}/bed_menu.aspx".format(NPM_BASE_URL)
+    try:
+        r = http_session.get(check_url)
+        if r.status_code == 200 and verbose:
+            print('Check connect OK')
+        return True
+    except Exception as ex:
+        if verbose:
+            print(str(ex))
+        return False
+
+
+def resolve_date_range(lodge_campsite, start_date=None, end_date=None, team_number=None, check_retain=None, verbose=True):
+    """Check the query dates and return (start_date, end_date, date_range), date_range holding ROC dates such as 108-03-05."""
+    # Check if start_data and end_date correctly
     if check_retain:
-        start_date = check_start_date
-        end_date = check_end_date
-    else:
-        start_date = datetime.strftime(date.today() + timedelta(days=7), "%Y-%m-%d")
-        end_date = datetime.strftime(date.today() + timedelta(days=28), "%Y-%m-%d")
-    print("你沒有輸入入園和下山日期，將自動搜尋{}到{}之間的入園申請狀況".format(start_date, end_date))
-elif start_date and not end_date:
-    if team_number:
-        end_date = datetime.strftime(datetime.strptime(start_date, '%Y-%m-%d') + timedelta(days=len(lodge_campsite)), "%Y-%m-%d")
-        print("你沒有輸入下山日期，將自動搜尋{}到{}之間的入園申請狀況".format(start_date, end_date))
-else:
-    print("您輸入了{}個山屋/營地名稱，請選擇入園日期、下山日期、隊伍人數，來查詢可申請時段\n或者不輸入入園日期、下山日期，將會自動搜尋7日以後到30日以內的所有可申請時段".format(len(lodge_campsite)))
-    exit(0)
-
-# Define National Park name and Lodge lists
-national_park_list = ["玉山", "太魯閣", "雪霸"]
-for np_item in national_park_list:
-    national_park = national_park.replace("國家公園", "")
-    if national_park in national_park_list:
-        if '玉山' == national_park:
-            get_lodge_link = "bed_6.aspx"
-            check_bed_link = "bed_6main.aspx"
-        elif '雪霸' in national_park:
-            get_lodge_link = "bed_1.aspx"
-            check_bed_link = "bed_1main.aspx"
-        elif '太魯閣' in national_park:
-            get_lodge_link = "bed_4.aspx"
-            check_bed_link = "bed_4main.aspx"
-
-        # Check if lodge name correct
-        hp = TaiwanNationalParkWebParser()
-        check_lodge_list_link = "https://npm.cpami.gov.tw/{}".format(get_lodge_link)
-        lodge_camp_list = hp.get_lodge_list(check_lodge_list_link)
-        for lodge in lodge_campsite:
-            if lodge not in lodge_camp_list:
-                print("{} <--名稱錯誤。\n請輸入正確的山屋/營地名稱。{}國家公園路線的山屋/營地如下：\n{}".format(lodge, national_park, list(lodge_camp_list.keys())))
-                exit(0)
+        check_start_date = datetime.strftime(date.today() + timedelta(days=35), "%Y-%m-%d")
+        check_end_date = datetime.strftime(date.today() + timedelta(days=120), "%Y-%m-%d")
+        if  start_date and start_date < check_start_date or end_date and end_date > check_end_date:
+            raise ValueError("外籍保留名額提前申請期限：預定入園日期前35天至前4個月間提出申請\n外籍保留名額可申請日期為：{} 到 {}".format(check_start_date, check_end_date))
+
+    # Set start_data and end_date
+    if start_date and end_date:
+        day_range = datetime.strptime(end_date, '%Y-%m-%d') - datetime.strptime(start_date, '%Y-%m-%d')
+        if day_range.days < len(lodge_campsite):
+            raise ValueError("您輸入了{}個山屋/營地名稱，請至少以{}天行程來查詢床位".format(len(lodge_campsite), len(lodge_campsite)+1))
+    elif not start_date and not end_date:
+        if check_retain:
+            start_date = check_start_date
+            end_date = check_end_date
+        else:
+            start_date = datetime.strftime(date.today() + timedelta(days=7), "%Y-%m-%d")
+            end_date = datetime.strftime(date.today() + timedelta(days=28), "%Y-%m-%d")
+        if verbose:
+            print("你沒有輸入入園和下山日期，將自動搜尋{}到{}之間的入園申請狀況".format(start_date, end_date))
+    elif start_date and not end_date:
+        if team_number:
+            end_date = datetime.strftime(datetime.strptime(start_date, '%Y-%m-%d') + timedelta(days=len(lodge_campsite)), "%Y-%m-%d")
+            if verbose:
+                print("你沒有輸入下山日期，將自動搜尋{}到{}之間的入園申請狀況".format(start_date, end_date))
     else:
-        print("請輸入正確的國家公園名稱，例如：玉山 / 太魯閣 / 雪霸")
-        exit(0)
+        raise ValueError("您輸入了{}個山屋/營地名稱，請選擇入園日期、下山日期、隊伍人數，來查詢可申請時段\n或者不輸入入園日期、下山日期，將會自動搜尋7日以後到30日以內的所有可申請時段".format(len(lodge_campsite)))
 
-# Check if input date format correctly
-try:
-    datetime.strptime(start_date, '%Y-%m-%d')
-    if end_date:
-        datetime.strptime(end_date, '%Y-%m-%d')
-except ValueError:
-    raise ValueError("Incorrect data format, should be YYYY-MM-DD")
+    # Check if input date format correctly
+    try:
+        datetime.strptime(start_date, '%Y-%m-%d')
+        if end_date:
+            datetime.strptime(end_date, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError("Incorrect data format, should be YYYY-MM-DD")
+
+    available_start_date = datetime.strftime(date.today() + timedelta(days=7), "%Y-%m-%d")
+    if start_date < available_start_date:
+        raise ValueError("僅提供7日以後申請案之進度查詢")
 
-available_start_date = datetime.strftime(date.today() + timedelta(days=7), "%Y-%m-%d")
-if start_date >= available_start_date:
     date_range = []
     # If endDate parameter provided, get the date list between startDate and endDate
     if end_date:
-        if end_date > start_date:
-            delta = datetime.strptime(end_date, "%Y-%m-%d").date() - datetime.strptime(start_date, "%Y-%m-%d").date()
-            for i in range(delta.days + 1):
-                #print(datetime.strptime(start_date, "%Y-%m-%d").date() + timedelta(i))
-                the_day = str(datetime.strptime(start_date, "%Y-%m-%d").date() + timedelta(i))
-                tmp = the_day.split("-")
-                dayOfWeek = datetime.strptime(the_day, "%Y-%m-%d").weekday()
-                # Ignore checking 'Friday' and 'Saturday' for querying foreigner retain number
-                if team_number and check_retain and (dayOfWeek == 4 or dayOfWeek == 5):
-                    continue
-                tmp[0] = str(int(tmp[0])-1911)
-                chinese_date = "-".join(tmp)
-                date_range.append(chinese_date)
-        else:
-            print("欲查詢的結束日期必須在開始日期之後")
-            exit(0)
+        if end_date <= start_date:
+            raise ValueError("欲查詢的結束日期必須在開始日期之後")
+        delta = datetime.strptime(end_date, "%Y-%m-%d").date() - datetime.strptime(start_date, "%Y-%m-%d").date()
+        for i in range(delta.days + 1):
+            the_day = str(datetime.strptime(start_date, "%Y-%m-%d").date() + timedelta(i))
+            tmp = the_day.split("-")
+            dayOfWeek = datetime.strptime(the_day, "%Y-%m-%d").weekday()
+            # Ignore checking 'Friday' and 'Saturday' for querying foreigner retain number
+            if team_number and check_retain and (dayOfWeek == 4 or dayOfWeek == 5):
+                continue
+            tmp[0] = str(int(tmp[0])-1911)
+            chinese_date = "-".join(tmp)
+            date_range.append(chinese_date)
     else:
         tmp = start_date.split("-")
         tmp[0] = str(int(tmp[0])-1911)
         chinese_date = "-".join(tmp)
         date_range.append(chinese_date)
-else:
-    print("僅提供7日以後申請案之進度查詢")
-    exit(0)
-
-
-lodge_available_list = {}
-check_orgid_url = "https://npm.cpami.gov.tw/bed_menu.spx"
-hp = TaiwanNationalParkWebParser()
-orgid = hp.parse_orgid(check_orgid_url)
-
-# Set process count
-if len(date_range) > multiprocessing.cpu_count():
-    pc = len(date_range)
-else:
-    pc = multiprocessing.cpu_count()
-
-# Implement multiprocessing Pool to improve the performance
-for lodge in range(len(lodge_campsite)):
-    checkList = []
-    inquire_url_list = []
-    for n in date_range:
-        inquire_url = "https://npm.cpami.gov.tw/{}?orgid={}&node_id={}&sdate={}".format(check_bed_link, orgid, lodge_camp_list[lodge_campsite[lodge]], n)
-        inquire_url_list.append(inquire_url)
-    #pool = Pool(processes=multiprocessing.cpu_count())
-    pool = Pool(processes=multiprocessing.cpu_count())
-    p = pool.map(functools.partial(hp.parse_url, np=national_park, lodge_id=lodge), inquire_url_list)
-    pool.terminate()
-    pool.join()
-    [checkList.append(i.get(lodge)) for i in p]
-    lodge_available_list.update({lodge : checkList})
-
-if team_number:
-    available_date = hp.check_available_apply_date()
-    if len(available_date) > 0:
-        print("隊伍{}人，共{}個時段可申請入園".format(team_number, len(available_date)))
+    return start_date, end_date, date_range
+
+
+def fetch_tasks(hp, tasks, engine, host_limit, parse_workers, pool, on_result):
+    """
+    Fetch and parse every (url, np, lodge_id) task with the engine of a scan, calling on_result(position, cell,
+    record) as each one is done, and return the number of workers that served them.
+    """
+    queued_at = time.time()
+    if engine == "async":
+        import asyncio
+        asyncio.run(hp.parse_urls_async([task + (queued_at,) for task in tasks], host_limit=host_limit,
+                                        parse_workers=parse_workers, on_result=on_result))
+        return min(host_limit, len(tasks))
+    # Small chunks keep every worker busy until the last cell of the matrix is done
+    for position, (cell, record) in pool.imap_unordered(hp.measure_task, [(position,) + task + (queued_at,) for position, task in enumerate(tasks)], chunksize=1):
+        on_result(position, cell, record)
+    return getattr(pool, '_processes', None) or multiprocessing.cpu_count()
+
+
+def park_links(national_park):
+    """Return (park name, lodge list page, check bed page) of a National Park, such as 玉山 or 玉山國家公園."""
+    national_park = national_park.replace("國家公園", "")
+    if national_park not in PARK_PAGES:
+        raise ValueError("請輸入正確的國家公園名稱，例如：玉山 / 太魯閣 / 雪霸")
+    return (national_park,) + PARK_PAGES[national_park]
+
+
+def parse_orgids(text):
+    """Return (link text, orgid) of every park on the bed_menu page."""
+    return [(item.text_content(), str(item.get('href').replace('apply_1_2.aspx?unit=', '')))
+            for item in orgid_link_xpath(parse_html(text))]
+
+
+def parse_lodge_list(text):
+    """Return {lodge name: node_id} of a bed_N lodge list page."""
+    # Every <option> with a node_id value, the '請選擇' placeholder has an empty one
+    items = [item for item in lodge_option_xpath(parse_html(text)) if item.get('value')]
+    return {item.text_content(): item.get('value') for item in items}
+
+
+async def fetch_tasks_async(hp, tasks, engine, host_limit, parse_workers, pool, on_result):
+    """fetch_tasks on the running event loop: on_result is called on the loop thread, which the Pool engine never blocks."""
+    import asyncio
+    queued_at = time.time()
+    if engine == "async":
+        await hp.parse_urls_async([task + (queued_at,) for task in tasks], host_limit=host_limit,
+                                  parse_workers=parse_workers, on_result=on_result)
+        return min(host_limit, len(tasks))
+    loop = asyncio.get_running_loop()
+    results = pool.imap_unordered(hp.measure_task, [(position,) + task + (queued_at,) for position, task in enumerate(tasks)], chunksize=1)
+    done = object()
+    # Each result is waited for on a thread, so other tasks of the loop run while the workers fetch
+    while True:
+        item = await loop.run_in_executor(None, next, results, done)
+        if item is done:
+            break
+        position, (cell, record) = item
+        on_result(position, cell, record)
+    return getattr(pool, '_processes', None) or multiprocessing.cpu_count()
+
+
+def fetch_park_ids(hp, base_url, get_lodge_link):
+    """
+    Download the lodge list and the orgid of the park of a parser, return ({lodge name: node_id}, orgid).
+    Raises ConnectionError when either page cannot be had, so a site that is down is not taken for a wrong name.
+    """
+    lodge_camp_list = hp.get_lodge_list("{}/{}".format(base_url, get_lodge_link))
+    if lodge_camp_list is None:
+        raise ConnectionError("無法取得{}國家公園的山屋/營地列表，請稍後再試".format(hp.national_park))
+    orgid = hp.parse_orgid("{}/bed_menu.aspx".format(base_url))
+    if orgid is None:
+        raise ConnectionError("無法取得{}國家公園的 orgid，請稍後再試".format(hp.national_park))
+    return lodge_camp_list, orgid
+
+
+def scan(*args, **kwargs):
+    """Run scan_async, with the same arguments, in an event loop of its own and return its ScanResult."""
+    import asyncio
+    return asyncio.run(scan_async(*args, **kwargs))
+
+
+async def scan_async(national_park, lodge_campsite, start_date=None, end_date=None, team_number=None, check_retain=None,
+                     engine='pool', host_limit=100, parse_workers=0, page_parser='lxml', as_frame=False, itinerary=None, pool=None,
+                     base_url=None, journal=None, resume=False, cell_retries=1, on_window=None, catalog=None, verbose=False):
+    """
+    Query every lodge on every date of the range and return a ScanResult. A coroutine, so a service that
+    already runs an event loop awaits it there; scan() runs it in a loop of its own.
+
+    Wrong park, lodge names or dates raise ValueError with the message the CLI prints, and ConnectionError when
+    the lodge list or orgid of the park cannot be downloaded. 'pool' may be an
+    already running multiprocessing Pool, so a long-running process can serve many scans from warm workers;
+    its workers share the rate limiter of the site only when it was started with init_worker and worker_initargs().
+    DATAM tables come back as TableRows, or as pandas DataFrames with 'as_frame'. 'base_url' replaces
+    NPM_BASE_URL, such as the address of standin_server.py for a load test.
+
+    With a scan_journal.ScanJournal every cell is checkpointed as soon as it is done, and 'resume' skips the
+    cells an earlier run of the same scan already answered. A scan that ends without failures leaves the journal.
+    A failed cell is tried 'cell_retries' more times after the rest of the matrix, the ones still failed are
+    listed in ScanResult.failures.
+
+    With a team number, cells go into the window search as they arrive and on_window(date) is called as
+    soon as the window starting on that date is known to be free, while the rest of the matrix is fetched.
+
+    With a lodge_catalog.LodgeCatalog the park and lodge names are checked, and the orgid and node_ids taken,
+    from the catalog without any request; names that are close to a catalog name are taken for it and
+    listed in ScanResult.corrections. A name the catalog does not know is looked up in the site's lodge list
+    before it is rejected.
+    """
+    import asyncio
+    base_url = (base_url or NPM_BASE_URL).rstrip('/')
+    national_park, get_lodge_link, check_bed_link = park_links(national_park)
+    start_date, end_date, date_range = resolve_date_range(lodge_campsite, start_date, end_date, team_number, check_retain, verbose=verbose)
+
+    # Check if lodge name correct
+    hp = TaiwanNationalParkWebParser(national_park, team_number, check_retain, page_parser=page_parser, as_frame=as_frame, verbose=verbose)
+    park = catalog.park(national_park) if catalog is not None else None
+    # (name asked for, catalog name taken for it) of every lodge name that was corrected
+    corrections = []
+    if park is not None and park['orgid']:
+        lodge_camp_list = park['lodges']
+        matches = [catalog.lookup(national_park, lodge) for lodge in lodge_campsite]
+        if None in matches:
+            # The catalog can be up to max_age old, a lodge it has not seen is looked up once on the site itself
+            live = await asyncio.get_running_loop().run_in_executor(None, hp.get_lodge_list, "{}/{}".format(base_url, get_lodge_link))
+            if live:
+                lodge_camp_list = dict(lodge_camp_list, **live)
+                matches = [match or ((lodge, live[lodge]) if lodge in live else None) for lodge, match in zip(lodge_campsite, matches)]
+        for lodge, match in zip(lodge_campsite, matches):
+            if match is None:
+                raise ValueError("{} <--名稱錯誤。\n請輸入正確的山屋/營地名稱。{}國家公園路線的山屋/營地如下：\n{}".format(lodge, national_park, list(lodge_camp_list.keys())))
+            if match[0] != lodge:
+                corrections.append((lodge, match[0]))
+                if verbose:
+                    print("{} --> {}，以目錄中的名稱查詢".format(lodge, match[0]))
+        lodge_campsite = [name for name, node_id in matches]
+        orgid = park['orgid']
     else:
-        print("沒有任何可申請入園的時段")
+        lodge_camp_list, orgid = await asyncio.get_running_loop().run_in_executor(None, fetch_park_ids, hp, base_url, get_lodge_link)
+        for lodge in lodge_campsite:
+            if lodge not in lodge_camp_list:
+                raise ValueError("{} <--名稱錯誤。\n請輸入正確的山屋/營地名稱。{}國家公園路線的山屋/營地如下：\n{}".format(lodge, national_park, list(lodge_camp_list.keys())))
+
+    # Put every (lodge, date) query into one work queue, so a single long-lived
+    # multiprocessing Pool serves the whole matrix instead of one Pool per lodge
+    inquire_task_list = []
+    cell_keys = []
+    for lodge in range(len(lodge_campsite)):
+        for n in date_range:
+            inquire_url = "{}/{}?orgid={}&node_id={}&sdate={}".format(base_url, check_bed_link, orgid, lodge_camp_list[lodge_campsite[lodge]], n)
+            inquire_task_list.append((inquire_url, national_park, lodge))
+            cell_keys.append((lodge, n))
+
+    # Windows are searched while the scan runs, the first one is known as soon as its own cells are in
+    tracker = hp.window_tracker(lodge_campsite, date_range, itinerary) if team_number else None
+    first_window_s = None
+
+    cells = [None] * len(inquire_task_list)
+    records = [None] * len(inquire_task_list)
+    errors = [None] * len(inquire_task_list)
+    attempts = [0] * len(inquire_task_list)
+
+    def evaluate(index, cell):
+        """Feed an answered cell to the window search and report the windows it completed."""
+        nonlocal first_window_s
+        if tracker is None or cell is None:
+            return
+        for start in tracker.add(cell_keys[index][0], index % len(date_range), cell.available):
+            if first_window_s is None:
+                first_window_s = perf_counter() - scan_started
+            if verbose:
+                print(date_range[start], "尚可申請入園")
+            if on_window is not None:
+                on_window(date_range[start])
+
+    scan_started = perf_counter()
+    if journal is not None:
+        import scan_journal
+        scan_id = scan_journal.scan_key(national_park, lodge_campsite, date_range, team_number, check_retain, base_url)
+        journal.start(scan_id, national_park, lodge_campsite, date_range, resume=resume)
+        if resume:
+            done = journal.done(scan_id)
+            for index, key in enumerate(cell_keys):
+                if key in done:
+                    cells[index] = cell_from_data(done[key], as_frame)
+                    evaluate(index, cells[index])
+            if verbose:
+                print("從中斷處繼續查詢：已完成{}個，尚有{}個日期需要查詢".format(len(done), cells.count(None)))
+
+    def store(index, cell, record):
+        """Keep the outcome of one attempt at a cell and checkpoint it."""
+        attempts[index] += 1
+        cells[index], records[index] = cell, record
+        if cell is None:
+            errors[index] = record['error'] or ("HTTP {}".format(record['status']) if record['status'] else "無回應")
+        if journal is not None:
+            journal.record(scan_id, cell_keys[index][0], cell_keys[index][1], cell_to_data(cell) if cell is not None else None, errors[index] if cell is None else None)
+        evaluate(index, cell)
+
+    # Create the limiter of the site before the Pool forks, so every worker shares its window and backoff
+    limiter = rate_limiter.limiter_for(urlparse(base_url).netloc)
+    own_pool = engine != "async" and pool is None
+    if own_pool:
+        pool = Pool(processes=multiprocessing.cpu_count(), initializer=init_worker, initargs=worker_initargs())
+    try:
+        started = perf_counter()
+        workers = 1
+        # First pass over the whole matrix, then another over the cells that failed for each retry
+        for _ in range(cell_retries + 1):
+            # Date-major order, so the cells of the earliest windows of every lodge come back first
+            pending = sorted((index for index, cell in enumerate(cells) if cell is None), key=lambda index: (index % len(date_range), index))
+            if not pending:
+                break
+            workers = await fetch_tasks_async(hp, [inquire_task_list[index] for index in pending], engine, host_limit, parse_workers, pool,
+                                              lambda position, cell, record: store(pending[position], cell, record))
+        wall_s = perf_counter() - started
+    finally:
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+    result = ScanResult(national_park, lodge_campsite, date_range, cells, records=records,
+                        metrics=scan_metrics.summarize(records, wall_s, workers))
+    result.failures = [(lodge_campsite[cell_keys[index][0]], cell_keys[index][1], attempts[index], errors[index])
+                       for index, cell in enumerate(cells) if cell is None]
+    result.corrections = corrections
+    if journal is not None:
+        result.scan_id = scan_id
+    if journal is not None and not result.failures:
+        journal.finish(scan_id)
+    if limiter is not None:
+        result.metrics['limiter'] = limiter.stats()
+    if tracker is not None:
+        result.available_date = [date_range[start] for start in tracker.starts()]
+        result.metrics['first_window_s'] = first_window_s
+    return result
+
+
+def main(argv=None):
+    # Set up arguments for this program
+    parser = argparse.ArgumentParser(description="Have fun dude!", formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-p", "--park", required=True, help="<Required> National Park that you plan to visit")
+    parser.add_argument('-l','--lodge', required=True, nargs='+', help="<Required> One or more Lodge/Campsite where you plan to stay. For example: -l 三六九山莊 七卡山莊")
+    parser.add_argument("-s", "--start", required=False, help="Use this parameter to query single date status. The query date must be 7 days later. Format example: 2019-02-02")
+    parser.add_argument("-e", "--end", required=False, help="Use this parameter to query multiple date from startDate to endDate. Format example: 2019-02-22")
+    parser.add_argument("-n", "--number", required=False, help="Team numbers that you plan to apply for permit. For example: -n 5")
+    parser.add_argument("-r", "--retain", required=False, help="Check if still have retained room number for foreigner. Follow the -n argument. For example: -n 5 -r yes")
+    parser.add_argument("--engine", choices=["pool", "async"], default="pool", help="Fetch engine. 'pool' forks one process per CPU, 'async' keeps many requests in flight from one process. Default: pool")
+    parser.add_argument("--host-limit", type=int, default=100, help="Max requests in flight per host for --engine async. Default: 100")
+    parser.add_argument("--pool-size", type=int, default=http_session.DEFAULT_POOL_SIZE, help="Keep-alive connections kept open per host in each worker. Default: {}".format(http_session.DEFAULT_POOL_SIZE))
+    parser.add_argument("--rps", type=float, default=rate_limiter.DEFAULT_RPS, help="Requests per second ceiling for the web site, 0 for none. Default: {}".format(rate_limiter.DEFAULT_RPS))
+    parser.add_argument("--max-retries", type=int, default=rate_limiter.DEFAULT_MAX_RETRIES, help="Retries of a request that timed out or got 429/5xx, after a jittered backoff. Default: {}".format(rate_limiter.DEFAULT_MAX_RETRIES))
+    parser.add_argument("--no-adaptive", action="store_true", help="Turn the adaptive rate limiter off: no concurrency window, rps ceiling, backoff or retry")
+    parser.add_argument("--resume", action="store_true", help="Continue the same scan from its journal, only the dates that are missing or failed are queried")
+    parser.add_argument("--cell-retries", type=int, default=1, help="More passes over the dates that failed after the first pass. Default: 1")
+    parser.add_argument("--journal", help="SQLite checkpoint journal of the scan, see scan_journal.py. Default: ~/.cache/np-scraper/journal.sqlite")
+    parser.add_argument("--no-journal", action="store_true", help="Do not checkpoint the scan")
+    parser.add_argument("--catalog", help="Local catalog of the parks and lodges, see lodge_catalog.py. Default: ~/.cache/np-scraper/catalog.json")
+    parser.add_argument("--no-catalog", action="store_true", help="Check the park and lodge names against the web site instead of the local catalog")
+    parser.add_argument("--cache-dir", default=response_cache.DEFAULT_CACHE_DIR, help="Directory of the on-disk response cache. Default: {}".format(response_cache.DEFAULT_CACHE_DIR))
+    parser.add_argument("--no-cache", action="store_true", help="Always download pages from the web site and do not store them")
+    parser.add_argument("--bed-ttl", type=float, default=response_cache.DEFAULT_TTLS['bed'], help="Seconds to cache bed pages whose lottery is not drawn yet. Their queue and remaining bed counts are live, so they go stale. Default: 0, never cached")
+    parser.add_argument("--parser", choices=["lxml", "bs4"], default="lxml", help="Bed page extraction backend. Default: lxml")
+    parser.add_argument("--parse-workers", type=int, default=0, help="Worker processes for page parsing with --engine async, 0 parses in the main process. Default: 0")
+    parser.add_argument("-o", "--output", required=False, help="Write every summary and table of the scan once at the end. The format follows the extension: .xlsx / .csv / .jsonl / .parquet")
+    parser.add_argument("--output-format", choices=["xlsx", "csv", "jsonl", "parquet"], help="Export format when it differs from the --output extension")
+    parser.add_argument("--base-url", default=NPM_BASE_URL, help="Root of the permit web site, such as http://127.0.0.1:8800 for standin_server.py. Default: {}, set by the NPM_BASE_URL environment variable".format(NPM_BASE_URL))
+    parser.add_argument("--snapshot-db", help="SQLite file that keeps the quota counts of every scan, see snapshot_store.py. Default: ~/.cache/np-scraper/snapshots.sqlite")
+    parser.add_argument("--no-snapshot", action="store_true", help="Do not record the quota counts of this scan")
+    parser.add_argument("--metrics", help="Write per-request timings and the scan summary. .prom writes a Prometheus text file, anything else JSON lines")
+    parser.add_argument("--metrics-format", choices=["jsonl", "prom"], help="Metrics format when it differs from the --metrics extension")
+    parser.add_argument("--timing", action="store_true", help="Print how long each startup phase took and the per-stage latency of the scan. Use python -X importtime for a per-module import report")
+
+    # Combine all arguments into a list called args
+    since = perf_counter()
+    args = parser.parse_args(argv)
+    if args.resume and args.no_journal:
+        parser.error("--resume continues a scan from its journal and cannot be used with --no-journal")
+    since = mark('parse arguments', since)
+
+    # The async engine keeps host_limit requests in flight, so its pool must be as large to reuse them all
+    pool_size = max(args.pool_size, args.host_limit) if args.engine == "async" else args.pool_size
+    http_session.configure(pool_size=pool_size)
+    response_cache.configure(cache_dir=args.cache_dir, enabled=not args.no_cache, ttls={'bed': args.bed_ttl})
+    # The concurrency window never needs to be wider than what the engine can keep in flight
+    max_window = args.host_limit if args.engine == "async" else multiprocessing.cpu_count()
+    rate_limiter.configure(enabled=not args.no_adaptive, rps=args.rps, max_window=max_window, max_retries=args.max_retries)
+
+    catalog = None
+    refresh_due = False
+    if not args.no_catalog:
+        import lodge_catalog
+        catalog = lodge_catalog.LodgeCatalog(args.base_url, args.catalog or lodge_catalog.DEFAULT_CATALOG_PATH)
+        try:
+            refresh_due = catalog.ensure()
+        except Exception as ex:
+            # Without a catalog the names are checked against the web site as before
+            print(str(ex))
+            catalog = None
+        since = mark('catalog', since)
+
+    # A fresh catalog checks the names without the web site, which is only probed first when there is none or it is stale
+    if catalog is None or refresh_due:
+        connected = check_connection("{}/bed_menu.aspx".format(args.base_url.rstrip('/')), verbose=True)
+        since = mark('check connection', since)
+        if not connected:
+            return 0
+
+    journal = None
+    if not args.no_journal:
+        import scan_journal
+        journal = scan_journal.ScanJournal(args.journal or scan_journal.DEFAULT_JOURNAL_PATH)
+    try:
+        result = scan(args.park, args.lodge, args.start, args.end, args.number, args.retain,
+                      engine=args.engine, host_limit=args.host_limit, parse_workers=args.parse_workers,
+                      page_parser=args.parser, base_url=args.base_url, journal=journal, resume=args.resume,
+                      cell_retries=args.cell_retries, catalog=catalog, verbose=True)
+        failures = result.failures
+        if journal is not None and failures:
+            # The journal counts the attempts at a cell over every run of a resumed scan
+            failures = [(result.lodge_campsite[lodge_id], search_date, attempts, error)
+                        for lodge_id, search_date, attempts, error in journal.failures(result.scan_id)]
+    except (ValueError, ConnectionError) as ex:
+        print(str(ex))
+        return 0
+    finally:
+        if journal is not None:
+            journal.close()
+    since = mark('scan', since)
+    # A stale catalog is fetched again while the results are written out, after the scan so no worker forks meanwhile
+    refresher = catalog.refresh_in_background() if refresh_due else None
+
+    if failures:
+        print("共{}個查詢失敗：".format(len(failures)))
+        for lodge, search_date, attempts, error in failures:
+            print("  {} {} │ 嘗試{}次 │ {}".format(search_date, lodge, attempts, error))
+        if journal is not None:
+            print("加上 --resume 再執行一次，只會重新查詢失敗的日期")
+
+    if not args.no_snapshot:
+        import snapshot_store
+        store = snapshot_store.SnapshotStore(args.snapshot_db or snapshot_store.DEFAULT_DB_PATH)
+        try:
+            store.append(result)
+        finally:
+            store.close()
+        since = mark('snapshot', since)
+
+    if args.output:
+        import export
+        try:
+            for path in export.write_scan(args.output, result, args.output_format):
+                print("查詢結果已匯出至 {}".format(path))
+        except (ValueError, ImportError) as ex:
+            print(str(ex))
+        since = mark('export', since)
+
+    if args.metrics:
+        try:
+            scan_metrics.write_metrics(args.metrics, result.records, result.metrics, args.metrics_format)
+            print("掃描指標已寫入 {}".format(args.metrics))
+        except (ValueError, OSError) as ex:
+            print(str(ex))
+
+    if args.number:
+        if len(result.available_date) > 0:
+            print("隊伍{}人，共{}個時段可申請入園".format(args.number, len(result.available_date)))
+        else:
+            print("沒有任何可申請入園的時段")
+
+    if args.timing:
+        print_timings()
+        scan_metrics.print_summary(result.metrics)
+    if refresher is not None:
+        refresher.join()
+    return 0
+
+
+def print_timings():
+    """Print the recorded startup phases, a lazy import is counted in the phase that first needed it."""
+    print("Timing report:")
+    for phase, seconds in timings:
+        print("  {:<20} {:>9.1f} ms".format(phase, seconds * 1000))
+    print("  {:<20} {:>9.1f} ms".format('total', (perf_counter() - started_at) * 1000))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
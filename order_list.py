@@ -0,0 +1,90 @@
+# Order list of a jmlnt.forest.gov.tw member
+# --------------------------------------------------------------------------------------------------------------
+# parse_orders reads the list_table of the 我的訂單 page in one pass over its rows and yields one OrderRecord
+# per order, with the cancel SID of the 取消 link when the order can still be cancelled. OrderWatcher keeps
+# the order number -> 申請單狀態 snapshot of the last poll and reports only the orders whose status changed;
+# a page identical to the previous one is not parsed at all.
+# --------------------------------------------------------------------------------------------------------------
+
+import hashlib
+import re
+from collections import namedtuple
+
+NUMBER_COLUMN = '申請單編號'
+STATUS_COLUMN = '申請單狀態'
+CANCEL_COLUMN = '取消'
+
+# One order of the list. cancel_sid is None when the order can no longer be cancelled,
+# fields holds every column title -> cell text of the row
+OrderRecord = namedtuple('OrderRecord', ['number', 'status', 'cancel_sid', 'fields'])
+
+# An order whose status differs from the previous snapshot, old_status is None for a new order
+# and new_status None for an order that left the list
+StatusChange = namedtuple('StatusChange', ['number', 'old_status', 'new_status'])
+
+check_del_pattern = re.compile(r"checkDel\(\s*'?(\w+)")
+
+
+def cell_text(tag):
+    return tag.get_text().replace('\r', '').replace('\n', '').replace('\t', '')
+
+
+def parse_orders(table):
+    """Yield an OrderRecord for every order row of the list_table tag, in page order."""
+    columns = []
+    for row in table.find_all('tr'):
+        cells = row.find_all(['th', 'td'])
+        if cells and cells[0].name == 'th':
+            columns = [cell_text(th) for th in cells]
+            continue
+        if not columns or len(cells) != len(columns):
+            continue
+        fields = {}
+        cancel_sid = None
+        for title, td in zip(columns, cells):
+            fields[title] = cell_text(td)
+            link = td.find('a', onclick=check_del_pattern)
+            if link is not None:
+                cancel_sid = check_del_pattern.search(link['onclick']).group(1)
+        yield OrderRecord(fields.get(NUMBER_COLUMN), fields.get(STATUS_COLUMN), cancel_sid, fields)
+
+
+def order_table(html):
+    """Return the list_table tag of the order page, None when the page has none."""
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, 'lxml').find("table", class_="list_table")
+
+
+def snapshot(records):
+    """Return {order number: status} of order records."""
+    return {record.number: record.status for record in records}
+
+
+def diff_orders(previous, current):
+    """Return the StatusChange of every order whose status differs between two snapshots."""
+    changes = [StatusChange(number, previous.get(number), status)
+               for number, status in current.items() if previous.get(number) != status]
+    changes.extend(StatusChange(number, status, None) for number, status in previous.items() if number not in current)
+    return changes
+
+
+class OrderWatcher:
+    """
+    Status snapshot of the order list between polls.
+    """
+    def __init__(self, previous=None):
+        self.previous = dict(previous or {})
+        self.records = []
+        self.digest = None
+
+    def update(self, html):
+        """Take the html of the order page, return the StatusChange of every order that moved since the last update."""
+        digest = hashlib.sha1(html.encode('utf-8')).digest()
+        if digest == self.digest:
+            return []
+        table = order_table(html)
+        records = list(parse_orders(table)) if table is not None else []
+        current = snapshot(records)
+        changes = diff_orders(self.previous, current)
+        self.previous, self.records, self.digest = current, records, digest
+        return changes
@@ -0,0 +1,163 @@
+# Adaptive per-host rate limiter shared by the scan workers
+# --------------------------------------------------------------------------------------------------------------
+# Each host gets an AIMD concurrency window: it grows by one request per window of answers while latency
+# stays close to the fastest seen, and halves (at most once per round trip) on a timeout, 429 or 5xx. A
+# failure also pauses the host for a full-jitter exponential backoff, and a token bucket keeps a hard ceiling
+# on requests per second. The timeout follows the smoothed round trip time like a TCP RTO.
+#
+# The state of a host lives in one multiprocessing.Array, so Pool workers forked by a scan share the same
+# window, bucket and backoff, and the async engine's fetch threads use it as well.
+# --------------------------------------------------------------------------------------------------------------
+
+import multiprocessing
+import random
+import threading
+import time
+
+DEFAULT_RPS = 20.0
+DEFAULT_INITIAL_WINDOW = 4
+DEFAULT_MAX_WINDOW = 64
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_MIN_TIMEOUT = 10.0
+MAX_TIMEOUT = 60.0
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+# An answer slower than this many times the fastest one does not grow the window
+LATENCY_FACTOR = 3.0
+POLL_INTERVAL = 0.005
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Fields of the shared state array
+WINDOW, IN_FLIGHT, TOKENS, REFILLED_AT, BACKOFF_UNTIL, FAILURES, TIMEOUTS, SRTT, RTTVAR, MIN_RTT, DECREASED_AT, DECREASES, BACKOFFS = range(13)
+N_FIELDS = 13
+
+_settings = {'enabled': True, 'rps': DEFAULT_RPS, 'initial_window': DEFAULT_INITIAL_WINDOW, 'max_window': DEFAULT_MAX_WINDOW,
+             'max_retries': DEFAULT_MAX_RETRIES, 'min_timeout': DEFAULT_MIN_TIMEOUT}
+_limiters = {}
+_lock = threading.Lock()
+
+
+class HostLimiter:
+    """
+    AIMD window, token bucket, backoff and round trip estimate of one host, in shared memory.
+    """
+    def __init__(self, host, rps=DEFAULT_RPS, initial_window=DEFAULT_INITIAL_WINDOW, max_window=DEFAULT_MAX_WINDOW,
+                 max_retries=DEFAULT_MAX_RETRIES, min_timeout=DEFAULT_MIN_TIMEOUT):
+        self.host = host
+        self.rps = rps
+        self.max_window = max_window
+        self.max_retries = max_retries
+        self.min_timeout = min_timeout
+        self.state = multiprocessing.Array('d', N_FIELDS)
+        self.state[WINDOW] = min(initial_window, max_window)
+        self.state[TOKENS] = 1
+        self.state[REFILLED_AT] = time.monotonic()
+
+    def acquire(self):
+        """Block until the host is out of backoff, the window has room and the bucket has a token."""
+        state = self.state
+        while True:
+            with state.get_lock():
+                now = time.monotonic()
+                wait = state[BACKOFF_UNTIL] - now
+                if wait <= 0:
+                    if self.rps:
+                        # A bucket of one token spaces requests evenly, so no burst goes over the ceiling
+                        state[TOKENS] = min(1.0, state[TOKENS] + (now - state[REFILLED_AT]) * self.rps)
+                        state[REFILLED_AT] = now
+                    has_token = not self.rps or state[TOKENS] >= 1
+                    if state[IN_FLIGHT] < int(state[WINDOW]) and has_token:
+                        state[IN_FLIGHT] += 1
+                        if self.rps:
+                            state[TOKENS] -= 1
+                        return
+                    wait = (1 - state[TOKENS]) / self.rps if not has_token else POLL_INTERVAL
+            time.sleep(max(wait, 0.001))
+
+    def release(self, outcome, latency):
+        """Give the slot back with the outcome of the request: 'ok', 'error' (429 or 5xx) or 'timeout'."""
+        state = self.state
+        with state.get_lock():
+            now = time.monotonic()
+            state[IN_FLIGHT] -= 1
+            if outcome == 'ok':
+                state[FAILURES] = 0
+                state[TIMEOUTS] = 0
+                # Smoothed round trip time and its variation, as RFC 6298 does for TCP
+                if state[SRTT] == 0:
+                    state[SRTT], state[RTTVAR] = latency, latency / 2
+                else:
+                    state[RTTVAR] = 0.75 * state[RTTVAR] + 0.25 * abs(state[SRTT] - latency)
+                    state[SRTT] = 0.875 * state[SRTT] + 0.125 * latency
+                state[MIN_RTT] = latency if state[MIN_RTT] == 0 else min(state[MIN_RTT], latency)
+                if latency <= LATENCY_FACTOR * state[MIN_RTT]:
+                    # Additive increase, about one more request per window of healthy answers
+                    state[WINDOW] = min(self.max_window, state[WINDOW] + 1 / state[WINDOW])
+                return
+
+            state[FAILURES] += 1
+            if outcome == 'timeout':
+                state[TIMEOUTS] += 1
+            # Multiplicative decrease, once per round trip so one burst of failures does not collapse the window
+            if now - state[DECREASED_AT] >= max(state[SRTT], 0.1):
+                state[WINDOW] = max(1.0, state[WINDOW] / 2)
+                state[DECREASED_AT] = now
+                state[DECREASES] += 1
+            backoff = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (state[FAILURES] - 1)))
+            state[BACKOFF_UNTIL] = max(state[BACKOFF_UNTIL], now + backoff)
+            state[BACKOFFS] += 1
+
+    def timeout(self):
+        """Request timeout: the RTO of the round trip estimate, at least min_timeout, doubled per consecutive timeout."""
+        state = self.state
+        with state.get_lock():
+            rto = max(self.min_timeout, state[SRTT] + 4 * state[RTTVAR])
+            return min(MAX_TIMEOUT, rto * 2 ** state[TIMEOUTS])
+
+    def stats(self):
+        """Return the current window and the counters of this host."""
+        state = self.state
+        with state.get_lock():
+            return {'host': self.host, 'window': state[WINDOW], 'srtt_s': state[SRTT], 'min_rtt_s': state[MIN_RTT],
+                    'decreases': int(state[DECREASES]), 'backoffs': int(state[BACKOFFS])}
+
+
+def configure(enabled=True, rps=None, initial_window=None, max_window=None, max_retries=None, min_timeout=None):
+    """Set how hosts are limited, and start every host afresh. Also used as Pool worker initializer."""
+    with _lock:
+        _settings['enabled'] = enabled
+        for key, value in (('rps', rps), ('initial_window', initial_window), ('max_window', max_window),
+                           ('max_retries', max_retries), ('min_timeout', min_timeout)):
+            if value is not None:
+                _settings[key] = value
+        _limiters.clear()
+
+
+def settings():
+    """Return a copy of the current settings, in the keyword form configure() takes."""
+    return dict(_settings)
+
+
+def limiter_for(host):
+    """Return the limiter of a host, None when limiting is off. Create it before forking to share it with the workers."""
+    if not _settings['enabled']:
+        return None
+    limiter = _limiters.get(host)
+    if limiter is None:
+        with _lock:
+            limiter = _limiters.get(host)
+            if limiter is None:
+                limiter = HostLimiter(host, **{k: v for k, v in _settings.items() if k != 'enabled'})
+                _limiters[host] = limiter
+    return limiter
+
+
+def limiters():
+    """Return the limiters of this process by host, for init_worker."""
+    return dict(_limiters)
+
+
+def install(host_limiters):
+    """Use limiters created by the parent process, so a worker shares their state."""
+    with _lock:
+        _limiters.update(host_limiters or {})
@@ -0,0 +1,119 @@
+# On-disk response cache for National Park pages
+# --------------------------------------------------------------------------------------------------------------
+# Page bodies are kept in one SQLite file keyed by URL. Each entry expires after the TTL of its page
+# type, and the oldest entries are evicted once the cache grows over its size limit. Bed pages whose
+# lottery is not drawn yet carry the live queue and 餘額 counts, so they are only cached when a bed TTL
+# is configured.
+# --------------------------------------------------------------------------------------------------------------
+
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'np-scraper')
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+
+# Time to live in seconds for each page type
+DEFAULT_TTLS = {
+    'orgid': 7 * 24 * 3600,        # bed_menu.aspx, park list with orgid
+    'lodge_list': 7 * 24 * 3600,   # bed_N.aspx, lodge names and node_id
+    'bed_drawn': 24 * 3600,        # bed_Nmain.aspx of a date whose lottery is already drawn
+    'bed': 0,                      # any other bed_Nmain.aspx, live counts: not cached unless opted in
+    'other': 10 * 60,
+}
+
+_settings = {'cache_dir': DEFAULT_CACHE_DIR, 'enabled': True, 'max_bytes': DEFAULT_MAX_BYTES, 'ttls': dict(DEFAULT_TTLS)}
+_conn = None
+_conn_pid = None
+_lock = threading.Lock()
+
+
+def configure(cache_dir=None, enabled=True, max_bytes=None, ttls=None):
+    """Set where and whether pages are cached. Also used as Pool worker initializer."""
+    global _conn
+    with _lock:
+        _settings['enabled'] = enabled
+        if cache_dir:
+            _settings['cache_dir'] = cache_dir
+        if max_bytes:
+            _settings['max_bytes'] = int(max_bytes)
+        if ttls:
+            _settings['ttls'].update(ttls)
+        # A forked worker leaves the copy inherited from its parent alone
+        if _conn is not None and _conn_pid == os.getpid():
+            _conn.close()
+        _conn = None
+
+
+def settings():
+    """Return a copy of the current settings, in the keyword form configure() takes."""
+    return {'cache_dir': _settings['cache_dir'], 'enabled': _settings['enabled'], 'max_bytes': _settings['max_bytes'], 'ttls': dict(_settings['ttls'])}
+
+
+def page_type_of(url):
+    """Tell the page type of a npm.cpami.gov.tw url from its path."""
+    path = url.split('?')[0].rsplit('/', 1)[-1]
+    if path.startswith('bed_menu'):
+        return 'orgid'
+    if path.startswith('bed_') and path.endswith('main.aspx'):
+        return 'bed'
+    if path.startswith('bed_'):
+        return 'lodge_list'
+    return 'other'
+
+
+def _connection():
+    """Return the SQLite connection of this process, a forked worker opens its own one."""
+    global _conn, _conn_pid
+    pid = os.getpid()
+    if _conn is None or _conn_pid != pid:
+        os.makedirs(_settings['cache_dir'], exist_ok=True)
+        conn = sqlite3.connect(os.path.join(_settings['cache_dir'], 'responses.sqlite'), timeout=30, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, page_type TEXT, body TEXT, size INTEGER, stored_at REAL, expires_at REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS responses_stored_at ON responses (stored_at)')
+        _conn, _conn_pid = conn, pid
+    return _conn
+
+
+def get(url):
+    """Return the cached body of url, or None if it is missing, expired or caching is off."""
+    if not _settings['enabled']:
+        return None
+    with _lock:
+        row = _connection().execute('SELECT body, expires_at FROM responses WHERE url = ?', (url,)).fetchone()
+    if row is None or row[1] < time.time():
+        return None
+    return row[0]
+
+
+def put(url, body, page_type=None):
+    """Store body for url with the TTL of its page type, then evict old entries over the size limit. A TTL of 0 stores nothing."""
+    if not _settings['enabled']:
+        return
+    page_type = page_type or page_type_of(url)
+    ttl = _settings['ttls'].get(page_type, _settings['ttls']['other'])
+    if ttl <= 0:
+        return
+    now = time.time()
+    size = len(body.encode('utf-8'))
+    with _lock:
+        conn = _connection()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', (url, page_type, body, size, now, now + ttl))
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+            if total > _settings['max_bytes']:
+                _evict(conn, total)
+
+
+def _evict(conn, total):
+    """Drop expired entries first and then the oldest ones until the cache is under 90% of its limit."""
+    conn.execute('DELETE FROM responses WHERE expires_at < ?', (time.time(),))
+    total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+    target = _settings['max_bytes'] * 0.9
+    for url, size in conn.execute('SELECT url, size FROM responses ORDER BY stored_at').fetchall():
+        if total <= target:
+            break
+        conn.execute('DELETE FROM responses WHERE url = ?', (url,))
+        total -= size
@@ -0,0 +1,79 @@
+# Indexed month calendar of the jmlnt.forest.gov.tw lodges
+# --------------------------------------------------------------------------------------------------------------
+# A parsed calendar page lists, for each day, the lodges followed by their free beds. RoomCalendar keeps the
+# month as a days x lodges int32 array of bed numbers with a lodge name -> column map, so the beds of any
+# (day, lodge) are one lookup and the availability of many lodges over many dates is one array comparison
+# that feeds availability.window_starts directly.
+# --------------------------------------------------------------------------------------------------------------
+
+import numpy as np
+
+# Bed number of a lodge that the calendar does not list on a day
+NOT_LISTED = -1
+
+
+class RoomCalendar:
+    """
+    Free beds of every lodge on every day of one month.
+    """
+    def __init__(self, year, month, lodges, labels, beds):
+        self.year = int(year)
+        self.month = int(month)
+        # Lodge names in column order, and the unit each one counts in, such as 床位
+        self.lodges = lodges
+        self.labels = labels
+        self.columns = {name: column for column, name in enumerate(lodges)}
+        # beds[day - 1, column], NOT_LISTED where the lodge is missing on that day
+        self.beds = beds
+
+    @classmethod
+    def from_days(cls, year, month, data_dict):
+        """Index the {day number: [(label, number), ...]} dict of LodgeRoomChecker.parse_calendar."""
+        lodges, labels, columns, cells = [], [], {}, []
+        for day, entries in data_dict.items():
+            lodge = None
+            for label, number in entries:
+                if number == '':
+                    # A lodge name, its bed number follows on the next entry
+                    lodge = label
+                    if lodge not in columns:
+                        columns[lodge] = len(lodges)
+                        lodges.append(lodge)
+                        labels.append('')
+                elif lodge is not None and number.isdigit():
+                    labels[columns[lodge]] = label
+                    cells.append((int(day), columns[lodge], int(number)))
+                    lodge = None
+        n_days = max([int(day) for day in data_dict] + [0])
+        beds = np.full((n_days, len(lodges)), NOT_LISTED, dtype=np.int32)
+        for day, column, number in cells:
+            beds[day - 1, column] = number
+        return cls(year, month, lodges, labels, beds)
+
+    def beds_of(self, day, lodge_name):
+        """Free beds of a lodge on a day of the month, NOT_LISTED if the calendar does not show it."""
+        column = self.columns.get(lodge_name)
+        if column is None or not 1 <= day <= self.beds.shape[0]:
+            return NOT_LISTED
+        return int(self.beds[day - 1, column])
+
+    def availability(self, days, lodge_list, team_number):
+        """lodges x days int8 matrix, 1 where the lodge has beds for the whole team on that day of the month."""
+        matrix = np.zeros((len(lodge_list), len(days)), dtype=np.int8)
+        day_index = np.asarray(days, dtype=np.int64) - 1
+        in_month = (day_index >= 0) & (day_index < self.beds.shape[0])
+        for row, lodge_name in enumerate(lodge_list):
+            column = self.columns.get(lodge_name)
+            if column is not None:
+                matrix[row, in_month] = self.beds[day_index[in_month], column] >= int(team_number)
+        return matrix
+
+    def summary(self, check_date, day):
+        """One line with every lodge and bed number of a day."""
+        if not 1 <= day <= self.beds.shape[0] or (self.beds[day - 1] == NOT_LISTED).all():
+            return "{} │ 所有床位/營地已額滿".format(check_date)
+        summarize = "{}".format(check_date)
+        for column, lodge_name in enumerate(self.lodges):
+            if self.beds[day - 1, column] != NOT_LISTED:
+                summarize += " │ {}  │ {} {}".format(lodge_name, self.labels[column], self.beds[day - 1, column])
+        return summarize
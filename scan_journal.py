@@ -0,0 +1,88 @@
+# Checkpoint journal of long scans
+# --------------------------------------------------------------------------------------------------------------
+# Every (lodge, date) cell of a scan is written to a SQLite journal as soon as it is answered or has failed.
+# A scan is identified by its park, lodges, dates, team number, retain flag and site, so running the same
+# scan again with --resume only fetches the cells that are missing or failed, instead of starting from zero
+# because of one bad response. A scan that finished without failures has nothing to resume and is dropped,
+# and scans not touched for max_age are expired, so the journal does not grow with every new query.
+# --------------------------------------------------------------------------------------------------------------
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+DEFAULT_JOURNAL_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'np-scraper', 'journal.sqlite')
+# Scans not updated for a week are dropped, their counts are stale by then
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+
+def scan_key(national_park, lodge_campsite, date_range, team_number=None, check_retain=None, base_url=None):
+    """Return the id of a scan, the same query gives the same id."""
+    key = json.dumps([national_park, list(lodge_campsite), list(date_range), team_number, check_retain, base_url], ensure_ascii=False)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class ScanJournal:
+    """
+    Journal of the cells of every scan, in SQLite.
+    """
+    def __init__(self, path=DEFAULT_JOURNAL_PATH, max_age=DEFAULT_MAX_AGE):
+        self.max_age = max_age
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS scans (scan_id TEXT PRIMARY KEY, park TEXT, lodges TEXT, '
+                          'first_date TEXT, last_date TEXT, started_at REAL, updated_at REAL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cells (scan_id TEXT, lodge_id INTEGER, search_date TEXT, status TEXT, '
+                          'attempts INTEGER, error TEXT, cell TEXT, updated_at REAL, PRIMARY KEY (scan_id, lodge_id, search_date))')
+
+    def start(self, scan_id, national_park, lodge_campsite, date_range, resume=False):
+        """Open the journal of a scan. Without resume its earlier cells are dropped and the scan starts from zero."""
+        now = time.time()
+        self.expire(now - self.max_age)
+        with self.conn:
+            if not resume:
+                self.conn.execute('DELETE FROM cells WHERE scan_id = ?', (scan_id,))
+            self.conn.execute('INSERT OR IGNORE INTO scans VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (scan_id, national_park, json.dumps(list(lodge_campsite), ensure_ascii=False),
+                               date_range[0] if date_range else None, date_range[-1] if date_range else None, now, now))
+            self.conn.execute('UPDATE scans SET updated_at = ? WHERE scan_id = ?', (now, scan_id))
+
+    def done(self, scan_id):
+        """Return {(lodge_id, search_date): cell data} of the cells of a scan that were answered."""
+        rows = self.conn.execute("SELECT lodge_id, search_date, cell FROM cells WHERE scan_id = ? AND status = 'ok'", (scan_id,))
+        return {(lodge_id, search_date): json.loads(cell) for lodge_id, search_date, cell in rows}
+
+    def record(self, scan_id, lodge_id, search_date, cell=None, error=None):
+        """Write the outcome of one attempt at a cell: its data when answered, otherwise the error."""
+        status = 'ok' if cell is not None else 'failed'
+        data = json.dumps(cell, ensure_ascii=False) if cell is not None else None
+        with self.conn:
+            self.conn.execute('INSERT INTO cells VALUES (?, ?, ?, ?, 1, ?, ?, ?) ON CONFLICT (scan_id, lodge_id, search_date) DO UPDATE '
+                              'SET status = excluded.status, attempts = attempts + 1, error = excluded.error, cell = excluded.cell, '
+                              'updated_at = excluded.updated_at',
+                              (scan_id, lodge_id, search_date, status, error, data, time.time()))
+            self.conn.execute('UPDATE scans SET updated_at = ? WHERE scan_id = ?', (time.time(), scan_id))
+
+    def failures(self, scan_id):
+        """Return (lodge_id, search_date, attempts, error) of the cells of a scan that are still failed."""
+        return self.conn.execute("SELECT lodge_id, search_date, attempts, error FROM cells WHERE scan_id = ? AND status = 'failed' "
+                                 "ORDER BY lodge_id, search_date", (scan_id,)).fetchall()
+
+    def finish(self, scan_id):
+        """Drop a scan that ended without failed cells, a later --resume of it has nothing to continue."""
+        with self.conn:
+            self.conn.execute('DELETE FROM cells WHERE scan_id = ?', (scan_id,))
+            self.conn.execute('DELETE FROM scans WHERE scan_id = ?', (scan_id,))
+
+    def expire(self, before):
+        """Drop the scans last updated before the time.time() 'before', and their cells."""
+        with self.conn:
+            self.conn.execute('DELETE FROM cells WHERE scan_id IN (SELECT scan_id FROM scans WHERE updated_at < ?)', (before,))
+            self.conn.execute('DELETE FROM scans WHERE updated_at < ?', (before,))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,159 @@
+# Per-request and per-scan metrics
+# --------------------------------------------------------------------------------------------------------------
+# Every (lodge, date) query of a scan leaves one record: queue wait before a worker picked it up, wait for a
+# slot of the rate limiter, connect / time to first byte / download time, bytes, HTTP status, retries, decode
+# time and where the charset came from, parse time and the error if it failed.
+# The scan summary aggregates them into p50/p95/p99 per stage, throughput and worker utilization, so a slow
+# scan shows whether it is network, parse or scheduler bound. Both are written as JSON lines or as a
+# Prometheus text file for the node_exporter textfile collector.
+# --------------------------------------------------------------------------------------------------------------
+
+import json
+import os
+import threading
+import time
+
+FORMATS = ('jsonl', 'prom')
+STAGES = ('queue_wait', 'limiter_wait', 'connect', 'ttfb', 'download', 'decode', 'fetch', 'parse')
+PERCENTILES = (50, 95, 99)
+
+
+def new_record(url, lodge_id, queued_at=None):
+    """Start the record of one query, queued_at is the time.time() it was handed to the workers."""
+    now = time.time()
+    return {'url': url, 'lodge_id': lodge_id, 'worker': "{}/{}".format(os.getpid(), threading.current_thread().name),
+            'started_at': now, 'queue_wait_s': now - queued_at if queued_at else 0.0, 'cache_hit': False,
+            'status': None, 'bytes': 0, 'retries': 0, 'limiter_wait_s': 0.0, 'connect_s': 0.0, 'ttfb_s': 0.0, 'download_s': 0.0,
+            'decode_s': 0.0, 'charset': None, 'fetch_s': 0.0, 'parse_s': 0.0, 'error': None}
+
+
+def add_timing(record, timing):
+    """Copy the http_session timing of the request into the record, no timing means the page did not come from the network."""
+    if timing is None:
+        record['cache_hit'] = True
+        return
+    for key in ('status', 'bytes', 'retries', 'limiter_wait_s', 'connect_s', 'ttfb_s', 'download_s', 'decode_s', 'charset'):
+        record[key] = timing[key]
+
+
+def percentile(sorted_values, q):
+    """q-th percentile of an already sorted list, nearest-rank method."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(q / 100.0 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(records, wall_s, workers):
+    """Aggregate the records of a scan that took wall_s seconds on 'workers' pool processes or async slots."""
+    records = [record for record in records if record is not None]
+    fetched = [record for record in records if not record['cache_hit']]
+    summary = {'cells': len(records), 'requests': len(fetched), 'cache_hits': len(records) - len(fetched),
+               'errors': sum(1 for record in records if record['error'] or (record['status'] or 200) >= 400),
+               'retries': sum(record['retries'] for record in records), 'bytes': sum(record['bytes'] for record in records),
+               'wall_s': wall_s, 'workers': workers, 'cells_per_s': len(records) / wall_s if wall_s else 0.0,
+               'status': {}, 'charsets': {}, 'stages': {}}
+    for record in fetched:
+        key = str(record['status'])
+        summary['status'][key] = summary['status'].get(key, 0) + 1
+        # Where the charset of each page came from: header, meta, learned or detected
+        if record['charset']:
+            summary['charsets'][record['charset']] = summary['charsets'].get(record['charset'], 0) + 1
+    for stage in STAGES:
+        # Network stages only count the requests that went to the web site
+        values = sorted(record[stage + '_s'] for record in (fetched if stage in ('limiter_wait', 'connect', 'ttfb', 'download', 'decode') else records))
+        stats = {'p{}'.format(q): percentile(values, q) for q in PERCENTILES}
+        stats.update(sum=sum(values), count=len(values))
+        summary['stages'][stage] = stats
+    # fetch_s includes the wait for the rate limiter, a worker blocked on it is not busy
+    busy = summary['stages']['fetch']['sum'] - summary['stages']['limiter_wait']['sum'] + summary['stages']['parse']['sum']
+    summary['worker_utilization'] = busy / (wall_s * workers) if wall_s and workers else 0.0
+    return summary
+
+
+def output_format(path, fmt=None):
+    """Return the metrics format, given explicitly or taken from the file extension, JSON lines by default."""
+    fmt = fmt or ('prom' if os.path.splitext(path)[1].lower() in ('.prom', '.txt') else 'jsonl')
+    if fmt not in FORMATS:
+        raise ValueError("不支援的指標格式：{}，請使用 {}".format(fmt, " / ".join(FORMATS)))
+    return fmt
+
+
+def write_metrics(path, records, summary, fmt=None):
+    """Write the records and summary of a scan to path."""
+    if output_format(path, fmt) == 'prom':
+        write_prometheus(path, summary)
+    else:
+        write_jsonl(path, records, summary)
+
+
+def write_jsonl(path, records, summary):
+    """One 'request' line per query and a closing 'scan' line with the summary."""
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            if record is not None:
+                f.write(json.dumps(dict(record, type='request'), ensure_ascii=False) + '\n')
+        f.write(json.dumps(dict(summary, type='scan'), ensure_ascii=False) + '\n')
+
+
+def write_prometheus(path, summary):
+    """Write the summary in the Prometheus text exposition format, through a temporary file so a scrape never reads half of it."""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append("# HELP np_scraper_{} {}".format(name, help_text))
+        lines.append("# TYPE np_scraper_{} {}".format(name, kind))
+        for labels, value in samples:
+            label_text = ",".join('{}="{}"'.format(k, v) for k, v in labels)
+            lines.append("np_scraper_{}{} {}".format(name, "{" + label_text + "}" if label_text else "", value))
+
+    metric('scan_cells', 'gauge', "Lodge and date cells queried by the last scan.", [((), summary['cells'])])
+    metric('scan_requests', 'gauge', "Requests sent to the web site by the last scan, by HTTP status.",
+           [((('status', status),), count) for status, count in sorted(summary['status'].items())])
+    metric('scan_cache_hits', 'gauge', "Cells of the last scan answered from the response cache.", [((), summary['cache_hits'])])
+    metric('scan_errors', 'gauge', "Cells of the last scan that failed or got an HTTP error.", [((), summary['errors'])])
+    metric('scan_retries', 'gauge', "Retries of the last scan.", [((), summary['retries'])])
+    metric('scan_response_bytes', 'gauge', "Response bytes downloaded by the last scan.", [((), summary['bytes'])])
+    metric('scan_duration_seconds', 'gauge', "Wall time of the fetch and parse stage of the last scan.", [((), summary['wall_s'])])
+    metric('scan_cells_per_second', 'gauge', "Throughput of the last scan.", [((), summary['cells_per_s'])])
+    metric('scan_worker_utilization_ratio', 'gauge', "Share of worker time spent fetching or parsing.", [((), summary['worker_utilization'])])
+
+    metric('scan_charset_decodes', 'gauge', "Pages of the last scan by where their charset came from, 'detected' ran charset detection.",
+           [((('source', source),), count) for source, count in sorted(summary.get('charsets', {}).items())])
+    if summary.get('first_window_s') is not None:
+        metric('scan_first_window_seconds', 'gauge', "Time from the start of the last scan to its first free itinerary window.", [((), summary['first_window_s'])])
+
+    if summary.get('limiter'):
+        limiter = summary['limiter']
+        host = (('host', limiter['host']),)
+        metric('limiter_window', 'gauge', "Concurrency window of the rate limiter at the end of the last scan.", [(host, limiter['window'])])
+        metric('limiter_decreases', 'gauge', "Times the rate limiter halved its window since it was created.", [(host, limiter['decreases'])])
+        metric('limiter_backoffs', 'gauge', "Backoffs the rate limiter ordered since it was created.", [(host, limiter['backoffs'])])
+
+    samples = []
+    for stage, stats in summary['stages'].items():
+        samples += [((('stage', stage), ('quantile', q / 100.0)), stats['p{}'.format(q)]) for q in PERCENTILES]
+    metric('stage_seconds', 'summary', "Per-request time of each scan stage.", samples)
+    for stage, stats in summary['stages'].items():
+        lines.append('np_scraper_stage_seconds_sum{{stage="{}"}} {}'.format(stage, stats['sum']))
+        lines.append('np_scraper_stage_seconds_count{{stage="{}"}} {}'.format(stage, stats['count']))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+def print_summary(summary):
+    """Print the summary as a short table."""
+    print("{} cells in {:.2f} s ({:.1f}/s), {} requests, {} cache hits, {} errors, worker utilization {:.0%}".format(
+        summary['cells'], summary['wall_s'], summary['cells_per_s'], summary['requests'], summary['cache_hits'],
+        summary['errors'], summary['worker_utilization']))
+    if summary.get('charsets'):
+        print("  charset      " + ", ".join("{} {}".format(source, count) for source, count in sorted(summary['charsets'].items())))
+    if summary.get('first_window_s') is not None:
+        print("  first free window after {:.2f} s".format(summary['first_window_s']))
+    if summary.get('limiter'):
+        print("  rate limiter window {window:.1f}, srtt {srtt_s:.3f} s, {decreases} decreases, {backoffs} backoffs".format(**summary['limiter']))
+    for stage, stats in summary['stages'].items():
+        print("  {:<12} p50 {:>8.1f} ms  p95 {:>8.1f} ms  p99 {:>8.1f} ms".format(stage, stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000))
@@ -0,0 +1,106 @@
+# Cookie-only, write-behind persistence of login sessions
+# --------------------------------------------------------------------------------------------------------------
+# Only the cookies of a requests.Session and the time the session expires are kept, as a small JSON file.
+# Saving is debounced: a save request marks the session dirty and the file is written at most once every
+# 'interval' seconds, plus once more at exit. Each write goes to a temporary file that replaces the cache file
+# atomically, under an exclusive lock file, so several processes can share one cache file.
+# --------------------------------------------------------------------------------------------------------------
+
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: os.replace is still atomic, concurrent writers just are not serialized
+    fcntl = None
+
+DEFAULT_INTERVAL = 5.0
+
+
+def cookies_to_list(cookie_jar):
+    """Plain dicts of every cookie of a jar."""
+    return [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path, 'expires': c.expires,
+             'secure': c.secure, 'rest': {'HttpOnly': c.get_nonstandard_attr('HttpOnly')} if c.has_nonstandard_attr('HttpOnly') else {}}
+            for c in cookie_jar]
+
+
+class SessionStore:
+    """
+    Debounced cookie file of one login session.
+    """
+    def __init__(self, path, interval=DEFAULT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.session = None
+        self.expires_at = None
+        self.dirty = False
+        self.written_at = 0.0
+        self.timer = None
+        atexit.register(self.flush)
+
+    def load(self):
+        """Return (saved_at, expires_at, cookie dicts) of the cache file, None if it is missing or unreadable."""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            return data['saved_at'], data['expires_at'], data['cookies']
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def restore(self, session, cookies):
+        """Put saved cookie dicts back into a requests.Session."""
+        for cookie in cookies:
+            session.cookies.set_cookie(requests.cookies.create_cookie(**cookie))
+        return session
+
+    def save(self, session, expires_at):
+        """Ask for the session to be saved: written now if the last write is older than interval, else once the interval is over."""
+        with self.lock:
+            self.session = session
+            self.expires_at = expires_at
+            self.dirty = True
+            wait = self.written_at + self.interval - time.monotonic()
+            if wait > 0:
+                # Coalesce: one pending write covers every save asked for until it runs
+                if self.timer is None:
+                    self.timer = threading.Timer(wait, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """Write the pending save now, if there is one."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if not self.dirty:
+                return
+            data = {'saved_at': time.time(), 'expires_at': self.expires_at, 'cookies': cookies_to_list(self.session.cookies)}
+            self.write(data)
+            self.dirty = False
+            self.written_at = time.monotonic()
+
+    def write(self, data):
+        """Replace the cache file atomically, holding the lock file so writers of other processes wait their turn."""
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with open(self.path + '.lock', 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.session-', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
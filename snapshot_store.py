@@ -0,0 +1,107 @@
+# Time-series store of per-lodge, per-date quota counts
+# --------------------------------------------------------------------------------------------------------------
+# Every scan appends one compact row per (park, lodge, date) to a SQLite file. The rows are indexed by
+# (park, lodge, date, scraped_at), so the history of a counter such as the 排隊預約 queue of 排雲山莊 is read
+# from disk instead of re-scraping.
+#
+# Usage: python snapshot_store.py -l 排雲山莊 -f queue --days 30 [-p 玉山] [-d 2019-03-05]
+# --------------------------------------------------------------------------------------------------------------
+
+import argparse
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+DEFAULT_DB_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'np-scraper', 'snapshots.sqlite')
+
+# Counters of the summarize dict kept for each park: 玉山 has examine, 雪霸 and 太魯閣 have tbd, candidate and wait
+COUNTERS = ('current_available', 'pool_total', 'queue', 'examine', 'approved', 'tbd', 'candidate', 'wait')
+
+
+def roc_to_iso(roc_date):
+    """Turn an ROC date such as 108-03-05 into 2019-03-05."""
+    year, month, day = roc_date.split('-')
+    return "{:04d}-{}-{}".format(int(year) + 1911, month, day)
+
+
+def to_int(value):
+    """Counter text as an int, None when the page did not show a number."""
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
+
+
+class SnapshotStore:
+    """
+    Append-only store of scan snapshots in SQLite.
+    """
+    def __init__(self, path=DEFAULT_DB_PATH):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS snapshots (park TEXT, lodge TEXT, date TEXT, scraped_at REAL, '
+                          + ', '.join('{} INTEGER'.format(c) for c in COUNTERS) + ', available INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS snapshots_cell ON snapshots (park, lodge, date, scraped_at)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS snapshots_lodge ON snapshots (lodge, scraped_at)')
+
+    def append(self, result, scraped_at=None):
+        """
+        Append one row per (lodge, date) cell of a ScanResult that was fetched from the web site by this scan,
+        stamped with the time its request started, and return the number of rows written. Cells answered from
+        the response cache or restored from the scan journal were already observed and are not written again.
+        """
+        now = time.time()
+        rows = []
+        for index, cell in enumerate(result.cells):
+            if cell is None or cell.summarize is None:
+                continue
+            record = result.records[index] if result.records else {}
+            if record is None or record.get('cache_hit'):
+                continue
+            summarize = cell.summarize
+            rows.append([result.national_park, result.lodge_campsite[cell.lodge_id], roc_to_iso(cell.search_date),
+                         scraped_at or record.get('started_at') or now]
+                        + [to_int(summarize.get(c)) for c in COUNTERS] + [cell.available])
+        with self.conn:
+            self.conn.executemany('INSERT INTO snapshots VALUES ({})'.format(', '.join('?' * (len(COUNTERS) + 5))), rows)
+        return len(rows)
+
+    def history(self, lodge, field='queue', days=30, park=None, date=None):
+        """Return (scraped_at, date, value) of a counter of a lodge over the last 'days' days, oldest first."""
+        if field not in COUNTERS + ('available',):
+            raise ValueError("未知的欄位：{}，請使用 {}".format(field, " / ".join(COUNTERS + ('available',))))
+        query = 'SELECT scraped_at, date, {} FROM snapshots WHERE lodge = ? AND scraped_at >= ?'.format(field)
+        params = [lodge, time.time() - days * 24 * 3600]
+        if park:
+            query += ' AND park = ?'
+            params.append(park.replace("國家公園", ""))
+        if date:
+            query += ' AND date = ?'
+            params.append(date)
+        return self.conn.execute(query + ' ORDER BY scraped_at, date', params).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show how a quota counter of a lodge evolved over past scans")
+    parser.add_argument('-l', '--lodge', required=True, help="<Required> Lodge/Campsite name, for example: 排雲山莊")
+    parser.add_argument('-f', '--field', default='queue', help="Counter to show: {} or available. Default: queue".format(" / ".join(COUNTERS)))
+    parser.add_argument('--days', type=int, default=30, help="How many days back to look. Default: 30")
+    parser.add_argument('-p', '--park', help="National Park of the lodge")
+    parser.add_argument('-d', '--date', help="Only this stay date. Format example: 2019-03-05")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help="Snapshot database. Default: {}".format(DEFAULT_DB_PATH))
+    args = parser.parse_args()
+
+    store = SnapshotStore(args.db)
+    try:
+        for scraped_at, stay_date, value in store.history(args.lodge, args.field, args.days, args.park, args.date):
+            print("{} │ {} │ {}".format(datetime.fromtimestamp(scraped_at).strftime('%Y-%m-%d %H:%M'), stay_date, value))
+    except ValueError as ex:
+        print(str(ex))
+    finally:
+        store.close()
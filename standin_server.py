@@ -0,0 +1,236 @@
+# Local stand-in for the National Park permit and jmlnt lodge web sites
+# --------------------------------------------------------------------------------------------------------------
+# Serves the pages in fixtures/ under the paths the scrapers request, so full scans can run at realistic
+# scale without touching the government servers. bed_Nmain.aspx answers with the sdate and the lodge of the
+# query filled in, and its 餘額 and 排隊預約 vary per (node_id, sdate). Latency, error rate and a requests per
+# second ceiling are configurable, requests over the ceiling get 503 like the real site when it is overloaded.
+# Member pages need the cookie a POST to /members/ hands out, without it they redirect to the sign-in page.
+#
+# Usage: python standin_server.py [--port 8800] [--latency 80] [--jitter 40] [--error-rate 0.01] [--rps 50]
+#        python np_scraper.py -p 玉山 -l 排雲山莊 --base-url http://127.0.0.1:8800
+#        NPM_BASE_URL=http://127.0.0.1:8800 JMLNT_BASE_URL=http://127.0.0.1:8800 python login.py
+# --------------------------------------------------------------------------------------------------------------
+
+import argparse
+import os
+import random
+import re
+import threading
+import time
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Path of each page on the web sites and the fixture that stands in for it
+STATIC_PAGES = {
+    '/bed_menu.aspx': 'bed_menu.html',
+    '/bed_1.aspx': 'bed_1.html',
+    '/bed_4.aspx': 'bed_4.html',
+    '/bed_6.aspx': 'bed_6.html',
+}
+BED_PAGES = {
+    '/bed_1main.aspx': ('bed_1.html', 'bed_1main.html'),
+    '/bed_4main.aspx': ('bed_4.html', 'bed_4main.html'),
+    '/bed_6main.aspx': ('bed_6.html', 'bed_6main.html'),
+}
+EMPTY_BED_PAGE = '<html><body><form id="form1"></form></body></html>'
+LOGIN_OK_PAGE = '<html><body><h1>歡迎來到會員專區</h1></body></html>'
+SIGN_IN_PAGE = '<html><body><form method="post"><input name="is_uu"><input name="is_pp" type="password">會員登入</form></body></html>'
+SIGN_IN_PATH = '/members/?mode=sign_in'
+
+option_pattern = re.compile(r'<option value="([^"]+)">([^<]+)')
+
+
+def load_fixture(name):
+    """Return the text of a fixture file."""
+    with open(os.path.join(FIXTURE_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def set_span(text, name, value):
+    """Replace the text of the ContentPlaceHolder1_<name> span of a bed page."""
+    return re.sub(r'(<span id="ContentPlaceHolder1_{}">)[^<]*'.format(name), lambda m: m.group(1) + value, text, count=1)
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Threaded HTTP server that keeps the fixtures, the fault settings and the request counters."""
+    daemon_threads = True
+    # The async engine opens up to --host-limit connections at once
+    request_queue_size = 512
+
+    def __init__(self, address, latency=0.0, jitter=0.0, error_rate=0.0, rps=0.0, seed=None):
+        super().__init__(address, StandInHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rps = rps
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'errors': 0, 'throttled': 0}
+        # Token bucket of the requests per second ceiling, one second of burst
+        self.tokens = rps
+        self.refilled_at = time.monotonic()
+
+        self.pages = {path: load_fixture(name) for path, name in STATIC_PAGES.items()}
+        self.bed_templates = {}
+        self.lodges = {}
+        for path, (list_name, page_name) in BED_PAGES.items():
+            self.bed_templates[path] = load_fixture(page_name)
+            self.lodges[path] = dict(option_pattern.findall(load_fixture(list_name)))
+        self.calendar = load_fixture('jmlnt_calendar.html')
+        self.orders = load_fixture('jmlnt_orders.html')
+        # PHPSESSID of every member signed in since the server started
+        self.member_sessions = set()
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def admit(self):
+        """Take a token of the rps bucket, return False when the request is over the ceiling."""
+        if not self.rps:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rps, self.tokens + (now - self.refilled_at) * self.rps)
+            self.refilled_at = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def delay(self):
+        """Seconds to wait before answering, latency plus or minus a uniform jitter."""
+        with self.lock:
+            return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def fails(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def bed_page(self, path, query):
+        """Fill the bed page template of path with the lodge and date of the query."""
+        node_id = query.get('node_id', [''])[0]
+        sdate = query.get('sdate', [''])[0]
+        lodge = self.lodges[path].get(node_id)
+        if lodge is None or not sdate:
+            # The real site answers an unknown node_id with a page without any ContentPlaceHolder1_ field
+            return EMPTY_BED_PAGE
+        text = set_span(self.bed_templates[path], 'sdate', sdate)
+        text = set_span(text, 'room', lodge)
+        rng = random.Random('{}/{}'.format(node_id, sdate))
+        # 餘額 and 排隊預約 of 玉山 pages, so some dates have room for a team after the queue
+        vacancy = rng.randint(0, 60)
+        text = set_span(text, 'lbStatus_6', str(rng.randint(0, 40)))
+        return set_span(text, 'lbCnt1', '({},0)'.format(vacancy))
+
+    def sign_in(self):
+        """Return the PHPSESSID of a new member session."""
+        with self.lock:
+            session_id = 'standin{:08x}'.format(self.random.getrandbits(32))
+            self.member_sessions.add(session_id)
+            return session_id
+
+    def signed_in(self, cookie_header):
+        """True when the Cookie header carries the PHPSESSID of a member session of this server."""
+        cookies = SimpleCookie(cookie_header or '')
+        return 'PHPSESSID' in cookies and cookies['PHPSESSID'].value in self.member_sessions
+
+    def answer(self, path, query):
+        """Return (status, body) of a request, None as body for a 404."""
+        if path in self.pages:
+            return 200, self.pages[path]
+        if path in BED_PAGES:
+            return 200, self.bed_page(path, query)
+        if path.startswith('/members'):
+            return 200, LOGIN_OK_PAGE
+        if path == '/room/index.php':
+            return 200, self.orders if query.get('mode', [''])[0] == 'record' else self.calendar
+        if path == '/apply_2.aspx':
+            return 200, '<html><body>查無資料</body></html>'
+        return 404, None
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the pooled sessions of the scrapers reuse their connections as with the real site
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in two writes, without TCP_NODELAY each keep-alive answer waits for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.respond()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.respond()
+
+    def respond(self):
+        server = self.server
+        server.count('requests')
+        if not server.admit():
+            server.count('throttled')
+            return self.send_body(503, 'Service Unavailable')
+        time.sleep(server.delay())
+        if server.fails():
+            server.count('errors')
+            return self.send_body(500, 'Internal Server Error')
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path.startswith('/members') or (url.path == '/room/index.php' and query.get('mode', [''])[0] == 'record'):
+            if self.command == 'POST' and url.path.startswith('/members'):
+                return self.send_body(200, LOGIN_OK_PAGE, {'Set-Cookie': 'PHPSESSID={}; Path=/'.format(server.sign_in())})
+            if not server.signed_in(self.headers.get('Cookie')):
+                if self.path == SIGN_IN_PATH:
+                    return self.send_body(200, SIGN_IN_PAGE)
+                return self.send_body(302, '', {'Location': SIGN_IN_PATH})
+        status, body = server.answer(url.path, query)
+        self.send_body(status, body if body is not None else 'Not Found')
+
+    def send_body(self, status, text, headers=None):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Thousands of requests per scan, keep the console quiet
+        pass
+
+
+def start(host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, rps=0.0, seed=None):
+    """Start a stand-in server on a background thread and return it, latency and jitter in seconds, port 0 picks a free port."""
+    server = StandInServer((host, port), latency, jitter, error_rate, rps, seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the fixture pages as a local stand-in for the permit web sites")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to listen on. Default: 127.0.0.1")
+    parser.add_argument('--port', type=int, default=8800, help="Port to listen on. Default: 8800")
+    parser.add_argument('--latency', type=float, default=0, help="Milliseconds before every answer. Default: 0")
+    parser.add_argument('--jitter', type=float, default=0, help="Latency varies uniformly by up to this many milliseconds. Default: 0")
+    parser.add_argument('--error-rate', type=float, default=0, help="Share of requests answered with 500, such as 0.01. Default: 0")
+    parser.add_argument('--rps', type=float, default=0, help="Requests per second ceiling, requests over it get 503. Default: 0, no ceiling")
+    args = parser.parse_args()
+
+    server = StandInServer((args.host, args.port), args.latency / 1000, args.jitter / 1000, args.error_rate, args.rps)
+    print("Serving the fixtures on {}".format(server.base_url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(server.counters)